@@ -0,0 +1,271 @@
+import re
+import logging
+import asyncio
+import aiohttp
+from datetime import datetime, timedelta
+from lib.db import LibraryCatalogDocumentModel, LibraryCatalogIsbnModel, Handler
+from lib.config import Config
+from lib.latency import LatencyPolicy
+from lib.parsing import ParsingExecutor
+from lib.latest_books_scraper import Library5004 as NewsLibrary5004
+from lib.utils import bs4_scope, chunked, normalize_isbn, ProgressCounter
+
+
+def make_title_key(title):
+    # Skip statement of responsibility and subtitle of catalog titles.
+    title = re.split(r'\s+[/:]\s+', title or '', maxsplit=1)[0]
+    return re.sub(r'\W+', ' ', title).strip().lower() or None
+
+
+def make_author_words(author):
+    return set(re.sub(r'[\W\d]+', ' ', author or '').lower().split())
+
+
+def parse_catalog_page(url, content, options):
+    """Return catalog document and CSRF token found on document page."""
+    with bs4_scope(content) as document_page:
+        def get_label_value(label):
+            for label_tag in document_page.find_all('dt'):
+                if label_tag.text.strip().rstrip(':').strip() == label:
+                    value_tag = label_tag.find_next_sibling('dd')
+                    return value_tag.text.strip() if value_tag else None
+            return None
+
+        isbn_list = []
+        isbn_label = document_page.find('dt', string=re.compile(r'ISBN'))
+        isbn_list_tag = isbn_label.find_next_sibling('dd') if isbn_label else None
+        if isbn_list_tag:
+            isbn_list = [re.sub(r'[^\dX]+', '', child.string)
+                         for child in isbn_list_tag.children
+                         if child.string]
+
+        items = []
+        for item in document_page.select(options['items_query']):
+            item_signatures = item.select(options['location_details_query'])
+            items.append({
+                'docid': item.get(options['docid_key']),
+                'doclibid': item.get(options['doclibid_key']),
+                'locationid': item.get(options['locationid_key']),
+                'signature': (item_signatures[1].text.strip()
+                              if len(item_signatures) > 1 else None),
+            })
+
+        token_tag = document_page.select_one(options['token_query'])
+        token = token_tag.get('value') if token_tag else None
+
+        document = {
+            'url': url,
+            'title': get_label_value(options['title_label']),
+            'author': get_label_value(options['author_label']),
+            'isbn_list': [isbn for isbn in isbn_list if isbn],
+            'items': items,
+        }
+
+    return document, token
+
+
+class CatalogMirror:
+    """Local index of library catalog documents.
+
+    Documents linked from the library news feed are crawled in background and
+    stored with ISBN, title, author and item ids, so books are resolved to
+    catalog documents without running a catalog search. Documents older than
+    `catalog_invalidate_days` are refreshed by the crawler and ignored by
+    lookups. Mirror covers news feed acquisitions and documents found by
+    live searches only, not the full library holdings.
+    """
+    logger = logging.getLogger(__name__)
+    news_libraries = {'5004': NewsLibrary5004}
+
+    def __init__(self, library_id, full=False, handler=None):
+        self.library_id = str(library_id)
+        self.config = Config()[f'libraries:{self.library_id}']
+        # Refetch all documents instead of new and stale ones.
+        self.full = full
+
+        invalidate_days = self.config.getint('catalog_invalidate_days', fallback=7)
+        self.invalidate_date = datetime.utcnow() - timedelta(days=invalidate_days)
+        # Limit of open connections to library host.
+        self.connection_limit = self.config.getint('connection_limit', fallback=30)
+        # Number of fetched documents written to mirror in one transaction.
+        self.cache_batch_size = Config().getint('latest_books_scraper', 'cache_batch_size',
+                                                fallback=100)
+        # SQLite limits number of bound parameters in a single query.
+        self.query_chunk_size = 500
+
+        # Handler may be shared with library scraper.
+        self.handler = handler or Handler()
+        self.handler.create_all()
+
+        self.session = None
+        self.semaphore = None
+        self.latency = LatencyPolicy()
+        self.parser = ParsingExecutor()
+
+    @property
+    def parse_options(self):
+        return {
+            'items_query': self.config['library_items_query'],
+            'location_details_query': self.config['location_details_query'],
+            'docid_key': self.config['a11y_docid_key'],
+            'doclibid_key': self.config['a11y_doclibid_key'],
+            'locationid_key': self.config['a11y_locationid_key'],
+            'token_query': self.config['yii_token_query'],
+            'title_label': self.config.get('document_title_label', fallback='Tytuł'),
+            'author_label': self.config.get('document_author_label', fallback='Autor'),
+        }
+
+    def find_documents(self, book):
+        """Return mirrored documents matching book ISBN, or title and author."""
+        isbn = normalize_isbn(book.get('isbn'))
+        with self.handler.session_scope() as session:
+            query = session.query(LibraryCatalogDocumentModel).filter(
+                LibraryCatalogDocumentModel.library_id == self.library_id,
+                LibraryCatalogDocumentModel.created >= self.invalidate_date,
+            ).order_by(LibraryCatalogDocumentModel.url)
+
+            documents = query.join(
+                LibraryCatalogIsbnModel,
+                LibraryCatalogIsbnModel.url_md5 == LibraryCatalogDocumentModel.url_md5,
+            ).filter(
+                LibraryCatalogIsbnModel.library_id == self.library_id,
+                LibraryCatalogIsbnModel.isbn == isbn,
+            ).all() if isbn else []
+
+            if not documents:
+                title_key = make_title_key(book.get('title'))
+                author_words = make_author_words(book.get('author'))
+                documents = [
+                    document for document in query.filter(
+                        LibraryCatalogDocumentModel.title_key == title_key,
+                    )
+                    # Catalog authors are stored as "Surname, Name (dates)".
+                    if not (author_words and document.author)
+                    or author_words.issubset(make_author_words(document.author))
+                ] if title_key else []
+
+            return [{'url': document.url, 'items': document.items}
+                    for document in documents]
+
+    def store_documents(self, documents):
+        if not documents:
+            return
+
+        created = datetime.utcnow()
+        documents = {LibraryCatalogDocumentModel.md5_from_url(document['url']): document
+                     for document in documents}
+        with self.handler.session_scope() as session:
+            for url_md5_chunk in chunked(list(documents), self.query_chunk_size):
+                for model in (LibraryCatalogDocumentModel, LibraryCatalogIsbnModel):
+                    session.query(model).filter(
+                        model.url_md5.in_(url_md5_chunk),
+                    ).delete(synchronize_session=False)
+
+            session.bulk_insert_mappings(LibraryCatalogDocumentModel, [{
+                'url_md5': url_md5,
+                'library_id': self.library_id,
+                'url': document['url'],
+                'title': document['title'],
+                'author': document['author'],
+                'title_key': make_title_key(document['title']),
+                'isbn_list': document['isbn_list'],
+                'items': document['items'],
+                'created': created,
+            } for url_md5, document in documents.items()])
+            session.bulk_insert_mappings(LibraryCatalogIsbnModel, [{
+                'library_id': self.library_id,
+                'isbn': isbn,
+                'url_md5': url_md5,
+            } for url_md5, document in documents.items()
+                for isbn in set(map(normalize_isbn, document['isbn_list'])).difference([None])])
+
+    def get_fresh_document_urls(self, urls):
+        fresh_urls = set()
+        with self.handler.session_scope() as session:
+            for url_chunk in chunked(urls, self.query_chunk_size):
+                fresh_urls.update(row.url for row in session.query(
+                    LibraryCatalogDocumentModel.url
+                ).filter(
+                    LibraryCatalogDocumentModel.url_md5.in_([
+                        LibraryCatalogDocumentModel.md5_from_url(url) for url in url_chunk
+                    ]),
+                    LibraryCatalogDocumentModel.created >= self.invalidate_date,
+                ))
+        return fresh_urls
+
+    def get_stale_document_urls(self):
+        with self.handler.session_scope() as session:
+            return [row.url for row in session.query(LibraryCatalogDocumentModel.url).filter(
+                LibraryCatalogDocumentModel.library_id == self.library_id,
+                LibraryCatalogDocumentModel.created < self.invalidate_date,
+            )]
+
+    async def run_in_executor(self, func, *args):
+        # Database access is blocking, keep it off the event loop.
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def run(self):
+        asyncio.run(self.crawl())
+
+    async def crawl(self):
+        news_library = self.news_libraries[self.library_id](full=True, handler=self.handler)
+
+        connector = aiohttp.TCPConnector(limit=self.connection_limit,
+                                         limit_per_host=self.connection_limit)
+        async with aiohttp.ClientSession(connector=connector) as self.session:
+            news_library.session = self.session
+            news_library.latency = self.latency
+            book_urls = await news_library.get_book_urls(watermark_urls=[])
+
+            # Stale mirrored documents are refreshed along with new ones.
+            document_urls = list(dict.fromkeys(
+                book_urls + await self.run_in_executor(self.get_stale_document_urls)
+            ))
+            fresh_urls = (set() if self.full else
+                          await self.run_in_executor(self.get_fresh_document_urls,
+                                                     document_urls))
+            self.logger.info(f'Mirroring {len(document_urls) - len(fresh_urls)}'
+                             f' of {len(document_urls)} catalog documents')
+
+            self.semaphore = asyncio.Semaphore(self.connection_limit)
+            for url_chunk in chunked([url for url in document_urls if url not in fresh_urls],
+                                     self.cache_batch_size):
+                documents = await asyncio.gather(*[
+                    self.get_document(url) for url in url_chunk
+                ])
+                await self.run_in_executor(self.store_documents,
+                                           [document for document in documents if document])
+
+        self.latency.log_metrics(self.logger)
+
+    async def get_document(self, url):
+        try:
+            async with self.semaphore:
+                content = await self.latency.fetch(self.session, 'GET', url,
+                                                   raise_for_status=True)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.logger.error(f'Fetching catalog document failed: {e}')
+            return None
+
+        document, _ = await self.parser.run_async(parse_catalog_page, url, content,
+                                                  self.parse_options)
+        return document
+
+
+class CLICatalogMirror(CatalogMirror):
+    logger = logging.getLogger('script')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counter = None
+
+    async def crawl(self):
+        counter_title = 'Mirroring catalog documents '
+        with ProgressCounter(counter_title) as self.counter:
+            self.counter.update()
+            await super().crawl()
+
+    async def get_document(self, url):
+        document = await super().get_document(url)
+        self.counter.next()
+        return document
@@ -2,7 +2,7 @@ import json
 from datetime import datetime
 from sqlite3 import Connection as SQLite3Connection
 from sqlalchemy import engine_from_config, MetaData, Column, TypeDecorator, Index
-from sqlalchemy.types import CHAR, DateTime, Text, Integer
+from sqlalchemy.types import CHAR, DateTime, Text, Integer, Float
 from sqlalchemy.event import listens_for
 from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
@@ -86,6 +86,62 @@ class BookShelfInfoModel(Model):
         return md5(url.encode('utf-8')).hexdigest()
 
 
+class ProfileModel(Model):
+    __tablename__ = 'profile'
+
+    profile_name = Column(Text, primary_key=True)
+    profile_id = Column(Text, nullable=False)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ShelfSnapshotModel(Model):
+    __tablename__ = 'shelf_snapshot'
+
+    profile_id = Column(Text, primary_key=True)
+    shelf_id = Column(Text, primary_key=True)
+    shelf_name = Column(Text, nullable=False)
+    pager_count = Column(Integer, nullable=False)
+    # Ordered shelf listing entries.
+    books = Column(JsonType, nullable=False)
+    # Content hash of each listing page.
+    page_hashes = Column(JsonType, nullable=False)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ShelfPageJournalModel(Model):
+    __tablename__ = 'shelf_page_journal'
+
+    profile_id = Column(Text, primary_key=True)
+    shelf_id = Column(Text, primary_key=True)
+    page = Column(Integer, primary_key=True)
+    # Listing entries collected from the page.
+    books = Column(JsonType, nullable=False)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ShelfIsbnIndexModel(Model):
+    __tablename__ = 'shelf_isbn_index'
+
+    profile_name = Column(Text, primary_key=True)
+    shelf_name = Column(Text, primary_key=True)
+    # Checksum validated ISBN-13.
+    isbn = Column(CHAR(13), primary_key=True)
+    book = Column(JsonType, nullable=False)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_shelf_isbn_index_isbn', 'isbn'),
+    )
+
+
+class BookPriceModel(Model):
+    __tablename__ = 'book_price'
+
+    isbn = Column(CHAR(13), primary_key=True)
+    price = Column(Float, nullable=False)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
 class BookLibraryAvailabilityModel(Model):
     __tablename__ = 'book_library_availability'
 
@@ -118,3 +174,60 @@ class NewBooksInfoModel(Model):
     @staticmethod
     def md5_from_url(url):
         return md5(url.encode('utf-8')).hexdigest()
+
+
+class LibraryNewsWatermarkModel(Model):
+    __tablename__ = 'library_news_watermark'
+
+    library_id = Column(CHAR(4), primary_key=True)
+    # Recently seen news book urls, newest first.
+    book_urls = Column(JsonType, nullable=False)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class NewBooksIsbnModel(Model):
+    """Compact layout of NewBooksInfoModel with one row per book url."""
+    __tablename__ = 'new_books_isbn'
+
+    url_md5 = Column(CHAR(32), primary_key=True)
+    library_id = Column(CHAR(4), nullable=False)
+    isbn_list = Column(JsonType, nullable=False)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class LibraryCatalogDocumentModel(Model):
+    """Catalog document mirrored from library website."""
+    __tablename__ = 'library_catalog_document'
+
+    url_md5 = Column(CHAR(32), primary_key=True)
+    library_id = Column(CHAR(4), nullable=False)
+    url = Column(Text, nullable=False)
+    title = Column(Text)
+    author = Column(Text)
+    # Normalized title used to look up books without matching ISBN.
+    title_key = Column(Text)
+    isbn_list = Column(JsonType, nullable=False)
+    # Item and location ids used for availability checks.
+    items = Column(JsonType, nullable=False)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_library_catalog_document_title_key', 'library_id', 'title_key'),
+    )
+
+    @staticmethod
+    def md5_from_url(url):
+        return md5(url.encode('utf-8')).hexdigest()
+
+
+class LibraryCatalogIsbnModel(Model):
+    __tablename__ = 'library_catalog_isbn'
+
+    library_id = Column(CHAR(4), primary_key=True)
+    # Checksum validated ISBN-13.
+    isbn = Column(CHAR(13), primary_key=True)
+    url_md5 = Column(CHAR(32), primary_key=True)
+
+    __table_args__ = (
+        Index('ix_library_catalog_isbn_url_md5', 'url_md5'),
+    )
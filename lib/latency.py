@@ -0,0 +1,239 @@
+import math
+import time
+import asyncio
+import logging
+import aiohttp
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from threading import Lock
+from urllib.parse import urlparse
+from requests.exceptions import Timeout
+from lib.config import Config
+
+
+class HostLatency:
+    """Deadlines, hedging delay and metrics of requests sent to one host.
+
+    Hedging delay is the `hedge_quantile` of recent response times, it is
+    only used once `hedge_min_samples` responses were seen.
+    """
+
+    def __init__(self, host, config):
+        self.host = host
+        self.connect_timeout = self.get_option(config.getfloat, 'connect_timeout', 10.0)
+        self.read_timeout = self.get_option(config.getfloat, 'read_timeout', 30.0)
+        self.hedge = self.get_option(config.getboolean, 'hedge', False)
+        self.hedge_quantile = self.get_option(config.getfloat, 'hedge_quantile', 0.95)
+        self.hedge_min_samples = self.get_option(config.getint, 'hedge_min_samples', 20)
+        self.hedge_min_delay = self.get_option(config.getfloat, 'hedge_min_delay', 0.05)
+
+        self.samples = deque(maxlen=self.get_option(config.getint, 'sample_size', 200))
+        self.lock = Lock()
+        self.requests = 0
+        self.timeouts = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def get_option(self, getter, option, fallback):
+        # Host section overrides defaults of the latency section.
+        return getter(f'latency:{self.host}', option,
+                      fallback=getter('latency', option, fallback=fallback))
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    @property
+    def client_timeout(self):
+        return aiohttp.ClientTimeout(total=None,
+                                     sock_connect=self.connect_timeout,
+                                     sock_read=self.read_timeout)
+
+    def quantile(self, quantile):
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        return samples[max(math.ceil(quantile * len(samples)) - 1, 0)]
+
+    def hedge_delay(self, method):
+        # Only idempotent requests are duplicated.
+        if not self.hedge or method.upper() not in ('GET', 'HEAD'):
+            return None
+        if len(self.samples) < self.hedge_min_samples:
+            return None
+        return max(self.quantile(self.hedge_quantile), self.hedge_min_delay)
+
+    def record(self, elapsed):
+        with self.lock:
+            self.requests += 1
+            self.samples.append(elapsed)
+
+    def record_timeout(self):
+        with self.lock:
+            self.timeouts += 1
+
+    def record_hedge(self, won):
+        with self.lock:
+            self.hedged += 1
+            self.hedge_wins += won
+
+    def metrics(self):
+        p50, p95 = self.quantile(0.5), self.quantile(0.95)
+        return {
+            'host': self.host,
+            'requests': self.requests,
+            'timeouts': self.timeouts,
+            'hedged': self.hedged,
+            'hedge_wins': self.hedge_wins,
+            'p50': p50,
+            'p95': p95,
+        }
+
+    def __str__(self):
+        metrics = self.metrics()
+        if not metrics['requests'] and not metrics['timeouts']:
+            return f'{self.host}: no requests'
+
+        latency = (f'p50 {metrics["p50"] * 1000:.0f}ms, p95 {metrics["p95"] * 1000:.0f}ms, '
+                   if metrics['requests'] else '')
+        return (f'{self.host}: {metrics["requests"]} requests, {latency}'
+                f'{metrics["timeouts"]} timeouts, {metrics["hedged"]} hedged,'
+                f' {metrics["hedge_wins"]} won by hedge')
+
+
+class LatencyPolicy:
+    """Per host request deadlines with optional hedged requests.
+
+    Defaults are read from the `latency` config section and overridden by
+    `latency:<host>` sections. Requests to hosts with hedging enabled are
+    duplicated when no response arrives within the hedging delay, and the
+    first successful response is used.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, workers=None):
+        self.config = Config()
+        self.workers = workers or self.config.getint('latency', 'hedge_workers', fallback=16)
+        self.hosts = {}
+        self.lock = Lock()
+        # Hedged blocking requests are sent from a thread pool.
+        self.executor = None
+
+    def __enter__(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.executor is not None:
+            # Losing requests are left to finish within their deadlines.
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def __iter__(self):
+        return iter(list(self.hosts.values()))
+
+    def get_host(self, url):
+        host = urlparse(url).hostname or ''
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostLatency(host, self.config)
+            return self.hosts[host]
+
+    def log_metrics(self, logger=None):
+        for host_latency in self:
+            (logger or self.logger).info(f'Latency of {host_latency}')
+
+    def request(self, session, method, url, **kwargs):
+        """Send blocking request with `requests` session, hedged if enabled."""
+        host_latency = self.get_host(url)
+        delay = host_latency.hedge_delay(method)
+        if delay is None or self.executor is None:
+            return self.request_once(host_latency, session, method, url, **kwargs)
+
+        futures = [self.executor.submit(self.request_once, host_latency, session,
+                                        method, url, **kwargs)]
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            self.logger.debug(f'Hedging request to {url} after {delay * 1000:.0f}ms')
+            futures.append(self.executor.submit(self.request_once, host_latency, session,
+                                                method, url, **kwargs))
+
+        error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if len(futures) > 1:
+                        host_latency.record_hedge(won=future is futures[1])
+                    # Losing response is closed, its connection is released.
+                    for pending_future in pending:
+                        pending_future.add_done_callback(self.close_response)
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    @staticmethod
+    def close_response(future):
+        if future.exception() is None:
+            future.result().close()
+
+    def request_once(self, host_latency, session, method, url, **kwargs):
+        start = time.monotonic()
+        try:
+            response = session.request(method, url, timeout=host_latency.timeout, **kwargs)
+        except Timeout as e:
+            host_latency.record_timeout()
+            self.logger.warning(f'Request to {url} exceeded deadline: {e}')
+            raise
+        host_latency.record(time.monotonic() - start)
+        return response
+
+    async def fetch(self, session, method, url, read=None, **kwargs):
+        """Read response of aiohttp session request, hedged if enabled.
+
+        Body is read with `read` coroutine function if given.
+        """
+        host_latency = self.get_host(url)
+        delay = host_latency.hedge_delay(method)
+        if delay is None:
+            return await self.fetch_once(host_latency, session, method, url, read, **kwargs)
+
+        tasks = [asyncio.ensure_future(self.fetch_once(host_latency, session,
+                                                       method, url, read, **kwargs))]
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            self.logger.debug(f'Hedging request to {url} after {delay * 1000:.0f}ms')
+            tasks.append(asyncio.ensure_future(self.fetch_once(host_latency, session,
+                                                               method, url, read, **kwargs)))
+
+        error = None
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if len(tasks) > 1:
+                            host_latency.record_hedge(won=task is tasks[1])
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            # Losing request is cancelled, its connection is released.
+            for task in pending:
+                task.cancel()
+
+    async def fetch_once(self, host_latency, session, method, url, read=None, **kwargs):
+        start = time.monotonic()
+        try:
+            async with session.request(method, url, timeout=host_latency.client_timeout,
+                                       **kwargs) as response:
+                content = await (read(response) if read else response.read())
+        except asyncio.TimeoutError:
+            host_latency.record_timeout()
+            self.logger.warning(f'Request to {url} exceeded deadline')
+            raise
+        host_latency.record(time.monotonic() - start)
+        return content
@@ -3,26 +3,111 @@ import json
 import logging
 import aiohttp
 import asyncio
-from sqlalchemy import func
 from itertools import chain
+from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta
-from lib.db import NewBooksInfoModel, Handler
+from lib.db import (NewBooksInfoModel, NewBooksIsbnModel, LibraryNewsWatermarkModel,
+                    ShelfIsbnIndexModel, Handler)
 from lib.xls import make_xls
 from lib.gdocs import get_service_client, write_rows_to_worksheet
 from lib.config import Config
 from lib.shelf_scraper import CLIShelfScraper
-from lib.utils import bs4_scope, ProgressCounter, shelf_name_to_file_path
+from lib.utils import (bs4_scope, chunked, normalize_isbn, EventLoopMonitor, ProgressCounter,
+                       shelf_name_to_file_path)
+from lib.parsing import ParsingExecutor, IncrementalExtractor
+from lib.latency import LatencyPolicy
+from lib.exceptions import BooksListUnavailable, LibraryNotSupported
+
+
+def parse_news_book_urls(content, base_url, selectors):
+    book_urls = []
+    with bs4_scope(content) as news_page:
+        for selector in selectors:
+            book_urls.extend([f'{base_url}{a["href"]}' for a in news_page.select(selector)])
+    return book_urls
+
+
+def parse_news_url_params(content, document_type_title, language_title, pagination_value,
+                          defaults):
+    with bs4_scope(content) as news_page:
+        document_type = news_page.select_one(f'a[title="{document_type_title}"]')\
+            .get('href', f'/news?{defaults["document_type"]}')\
+            .replace('/news?', '')
+
+        language = news_page.select_one(f'a[title="{language_title}"]')\
+            .get('href', f'/news?{defaults["language"]}')\
+            .replace('/news?', '')
+
+        pagination_re = re.compile(pagination_value)
+        pagination = news_page.find('a', string=pagination_re)\
+            .get('href', f'/news?{defaults["pagination"]}')\
+            .replace('/news?', '')
+
+    return document_type, language, pagination
+
+
+def parse_last_news_pager(content, last_page_title, news_path):
+    with bs4_scope(content) as news_page:
+        last_pager_re = re.compile(last_page_title)
+        last_pager_link = news_page.find('a', string=last_pager_re)
+        if not last_pager_link:
+            return None
+
+        return last_pager_link.get('href', '').replace(news_path, '')
+
+
+def parse_book_isbn(content):
+    with bs4_scope(content) as book_page:
+        isbn_label = book_page.find('dt', string=re.compile(r'ISBN'))
+        if not isbn_label:
+            return []
+
+        isbn_list_tag = isbn_label.find_next_sibling('dd')
+        if not isbn_list_tag:
+            return []
+
+        return [re.sub(r'[^\dX]+', '', child.string)
+                for child in isbn_list_tag.children
+                if child.string]
+
+
+class BookIsbnExtractor(IncrementalExtractor):
+    """Extract isbn list of `parse_book_isbn` and stop after the ISBN value."""
+
+    def __init__(self):
+        super().__init__()
+        self.isbn_label = None
+        self.isbn_list = []
+
+    def handle(self, event, element):
+        if event != 'end':
+            return
+
+        if element.tag == 'dt' and self.isbn_label is None\
+                and 'ISBN' in self.text(element):
+            self.isbn_label = element
+        elif element.tag == 'dd' and self.isbn_label is not None\
+                and element.getparent() is self.isbn_label.getparent():
+            values = [element.text]
+            for child in element:
+                values.extend((child.text if not len(child) else None, child.tail))
+            self.isbn_list = [re.sub(r'[^\dX]+', '', value) for value in values if value]
+            self.done = True
 
 
 class LibraryBase:
     logger = logging.getLogger(__name__)
     library_id = None
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, full=False, handler=None, **kwargs):
         self.config = Config()
         self.session = None
+        # Crawl whole news feed instead of stopping at known books.
+        self.full = full
 
-        self.handler = Handler()
+        # Handler may be shared by libraries crawled in one process.
+        self.handler = handler or Handler()
         self.handler.create_all()
 
         # Set invalidate date.
@@ -31,56 +116,184 @@ class LibraryBase:
                                              fallback=1)
         self.invalidate_date = datetime.utcnow() - timedelta(days=invalidate_days)
 
+        # Cached isbn lists are stored either as one row per isbn ("rows") or
+        # as one row per book url ("compact").
+        self.isbn_storage = self.config.get('latest_books_scraper', 'isbn_storage',
+                                            fallback='rows')
+        # SQLite limits number of bound parameters in a single query.
+        self.query_chunk_size = 500
+
+        # Books are fetched by a pool of workers reading from a bounded queue.
+        self.workers = self.config.getint('latest_books_scraper', 'workers', fallback=30)
+        self.queue_size = self.config.getint('latest_books_scraper', 'queue_size',
+                                             fallback=100)
+        # Number of fetched books written to cache in one transaction.
+        self.cache_batch_size = self.config.getint('latest_books_scraper',
+                                                   'cache_batch_size', fallback=100)
+
+        # Blocking database calls run on a dedicated worker thread.
+        self.db_executor = None
+        # Pages are parsed inline unless a shared parsing executor is given.
+        self.parser = ParsingExecutor()
+        # Book pages are read only until ISBN is found.
+        self.incremental_parsing = self.config.getboolean('latest_books_scraper',
+                                                          'incremental_parsing',
+                                                          fallback=True)
+        # Deadlines and hedging of requests, may be shared by libraries.
+        self.latency = LatencyPolicy()
+
     def __str__(self):
         return f'Library {self.library_id}'
 
-    async def get_books_isbn(self):
+    async def get_books_isbn(self, resolver=None):
         raise NotImplementedError()
 
-    async def get_book_isbn_from_link(book_url):
+    def store_watermark(self):
+        # Libraries without news feed watermark have nothing to store.
+        pass
+
+    async def get_book_isbn_from_link(self, book_url):
+        """Return isbn list of book, None when book page couldn't be fetched."""
         raise NotImplementedError()
 
+    async def get_books_isbn_from_urls(self, book_urls):
+        """Collect isbn set of given books with a bounded pool of workers.
+
+        Cached books are resolved in batches and the misses are passed
+        through a queue of `queue_size` urls to `workers` consumers. Fetched
+        results are streamed into the isbn set and written to cache in
+        batches, so memory use does not grow with number of books.
+        """
+        isbn_set = set()
+        books_queue = asyncio.Queue(maxsize=self.queue_size)
+        results_queue = asyncio.Queue(maxsize=self.queue_size)
+
+        tasks = [
+            asyncio.ensure_future(self.put_missing_book_urls(book_urls, books_queue, isbn_set)),
+            asyncio.ensure_future(self.store_fetched_books_isbn(results_queue, isbn_set)),
+            *[asyncio.ensure_future(self.fetch_books_isbn(books_queue, results_queue))
+              for _ in range(self.workers)],
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # Stop remaining tasks when one of them failed.
+            for task in tasks:
+                task.cancel()
+
+        return isbn_set
+
+    async def put_missing_book_urls(self, book_urls, books_queue, isbn_set):
+        cached_count = missing_count = 0
+        for book_urls_chunk in chunked(list(dict.fromkeys(book_urls)), self.query_chunk_size):
+            # Resolve cached books at once, fetch only the misses.
+            books_isbn = await self.prefetch_books_isbn(book_urls_chunk)
+            isbn_set.update(chain(*books_isbn.values()))
+            cached_count += len(books_isbn)
+
+            for book_url in book_urls_chunk:
+                if book_url not in books_isbn:
+                    missing_count += 1
+                    await books_queue.put(book_url)
+
+        self.logger.debug(f'Got {cached_count} cached books, fetching {missing_count} books')
+        for _ in range(self.workers):
+            await books_queue.put(None)
+
+    async def fetch_books_isbn(self, books_queue, results_queue):
+        while True:
+            book_url = await books_queue.get()
+            if book_url is None:
+                break
+            await results_queue.put(await self.get_book_isbn(book_url))
+        await results_queue.put(None)
+
+    async def store_fetched_books_isbn(self, results_queue, isbn_set):
+        fetched_books_isbn = {}
+        finished_workers = 0
+        while finished_workers < self.workers:
+            book_isbn = await results_queue.get()
+            if book_isbn is None:
+                finished_workers += 1
+                continue
+
+            book_url, isbn_list = book_isbn
+            # Failed fetches aren't cached, book is fetched again by next run.
+            if isbn_list is None:
+                continue
+
+            isbn_set.update(isbn_list)
+            fetched_books_isbn[book_url] = isbn_list
+            # Write fresh results back in batches.
+            if len(fetched_books_isbn) >= self.cache_batch_size:
+                await self.run_in_db_executor(self.store_books_isbn, fetched_books_isbn)
+                fetched_books_isbn = {}
+
+        await self.run_in_db_executor(self.store_books_isbn, fetched_books_isbn)
+
+    async def prefetch_books_isbn(self, book_urls):
+        return await self.run_in_db_executor(self.get_books_isbn_from_db, book_urls)
+
     async def get_book_isbn(self, book_url):
-        # Check if current page info exists in DB.
-        isbn_list = self.get_book_isbn_from_db(book_url)
-        if isbn_list is not None:
-            return isbn_list
+        return book_url, await self.get_book_isbn_from_link(book_url)
 
-        isbn_list = await self.get_book_isbn_from_link(book_url)
+    async def run_in_db_executor(self, func, *args):
+        # SQLAlchemy calls are blocking, keep them off the event loop.
+        return await asyncio.get_running_loop().run_in_executor(self.db_executor, func, *args)
 
-        if isbn_list:
-            self.store_book_isbn(book_url, isbn_list)
-        return isbn_list
+    def get_books_isbn_from_db(self, book_urls, invalidate_date=None):
+        invalidate_date = invalidate_date or self.invalidate_date
+        urls_by_md5 = {NewBooksInfoModel.md5_from_url(book_url): book_url
+                       for book_url in book_urls}
 
-    def get_book_isbn_from_db(self, book_url):
-        book_url_md5 = NewBooksInfoModel.md5_from_url(book_url)
-        with self.handler.session_scope() as session:
-            has_isbn = session.query(func.count(NewBooksInfoModel._pk))\
-                .filter(NewBooksInfoModel.url_md5 == book_url_md5,
-                        NewBooksInfoModel.created >= self.invalidate_date)\
-                .scalar()
-            if not has_isbn:
-                return None
-
-            return [
-                row.isbn for row in session
-                .query(NewBooksInfoModel.isbn)
-                .filter(NewBooksInfoModel.url_md5 == book_url_md5,
-                        NewBooksInfoModel.created >= self.invalidate_date)
-            ]
-
-    def store_book_isbn(self, book_url, isbn_list):
-        book_url_md5 = NewBooksInfoModel.md5_from_url(book_url)
+        books_isbn = {}
         with self.handler.session_scope() as session:
-            session.query(NewBooksInfoModel).filter(
-                NewBooksInfoModel.url_md5 == book_url_md5,
-            ).delete(synchronize_session=False)
+            for url_md5_chunk in chunked(list(urls_by_md5), self.query_chunk_size):
+                if self.isbn_storage == 'compact':
+                    rows = session.query(NewBooksIsbnModel.url_md5, NewBooksIsbnModel.isbn_list)\
+                        .filter(NewBooksIsbnModel.url_md5.in_(url_md5_chunk),
+                                NewBooksIsbnModel.created >= invalidate_date)
+                    books_isbn.update({urls_by_md5[row.url_md5]: row.isbn_list for row in rows})
+                else:
+                    rows = session.query(NewBooksInfoModel.url_md5, NewBooksInfoModel.isbn)\
+                        .filter(NewBooksInfoModel.url_md5.in_(url_md5_chunk),
+                                NewBooksInfoModel.created >= invalidate_date)
+                    for row in rows:
+                        books_isbn.setdefault(urls_by_md5[row.url_md5], []).append(row.isbn)
+
+        return books_isbn
+
+    def store_books_isbn(self, books_isbn):
+        rows = {NewBooksInfoModel.md5_from_url(book_url): isbn_list
+                for book_url, isbn_list in books_isbn.items()}
+        if self.isbn_storage != 'compact':
+            # Books without isbn have no rows to store.
+            rows = {url_md5: isbn_list for url_md5, isbn_list in rows.items() if isbn_list}
+        if not rows:
+            return
 
-            session.bulk_save_objects([NewBooksInfoModel(
-                url_md5=book_url_md5,
-                library_id=self.library_id,
-                isbn=isbn,
-            ) for isbn in isbn_list])
+        model = NewBooksIsbnModel if self.isbn_storage == 'compact' else NewBooksInfoModel
+        created = datetime.utcnow()
+        with self.handler.session_scope() as session:
+            for url_md5_chunk in chunked(list(rows), self.query_chunk_size):
+                session.query(model).filter(
+                    model.url_md5.in_(url_md5_chunk),
+                ).delete(synchronize_session=False)
+
+            if self.isbn_storage == 'compact':
+                session.bulk_insert_mappings(NewBooksIsbnModel, [{
+                    'url_md5': url_md5,
+                    'library_id': self.library_id,
+                    'isbn_list': isbn_list,
+                    'created': created,
+                } for url_md5, isbn_list in rows.items()])
+            else:
+                session.bulk_insert_mappings(NewBooksInfoModel, [{
+                    'url_md5': url_md5,
+                    'library_id': self.library_id,
+                    'isbn': isbn,
+                    'created': created,
+                } for url_md5, isbn_list in rows.items() for isbn in isbn_list])
 
 
 class Library4949(LibraryBase):
@@ -95,30 +308,115 @@ class Library5004(LibraryBase):
 
         self.news_url_template = self.config.get(f'libraries:{self.library_id}',
                                                  'news_url_template')
-
-    async def get_books_isbn(self):
-        # Limit number of open connections.
-        connector = aiohttp.TCPConnector(limit=30)
+        # Limit of open connections to library host.
+        self.connection_limit = self.config.getint(f'libraries:{self.library_id}',
+                                                   'connection_limit', fallback=30)
+        # Book urls of news feed, stored as watermark once results are written.
+        self.feed_urls = None
+        # Unset when a news page failed, so its books aren't marked as seen.
+        self.feed_complete = True
+
+    async def get_books_isbn(self, resolver=None):
+        # Each library has own connection limits, DNS resolver may be shared.
+        connector = aiohttp.TCPConnector(limit=self.connection_limit,
+                                         limit_per_host=self.connection_limit,
+                                         resolver=resolver)
         async with aiohttp.ClientSession(connector=connector) as self.session:
-            book_urls = await self.get_book_urls()
-
-            book_isbn_tasks = [self.get_book_isbn(book_url)
-                               for book_url in book_urls]
-
-            isbn_list = await asyncio.gather(*book_isbn_tasks)
-            isbn_set = set(chain(*isbn_list))
-
+            with ThreadPoolExecutor(max_workers=1) as self.db_executor:
+                watermark_urls = ([] if self.full else
+                                  await self.run_in_db_executor(self.get_watermark_urls))
+                book_urls = await self.get_book_urls(watermark_urls)
+
+                # Known books are resolved from cache regardless of its age.
+                watermark_urls = set(watermark_urls)
+                known_urls = [url for url in book_urls if url in watermark_urls]
+                known_books_isbn = await self.run_in_db_executor(
+                    self.get_books_isbn_from_db, known_urls, datetime.min,
+                )
+                isbn_set = await self.get_books_isbn_from_urls(
+                    [url for url in book_urls if url not in known_books_isbn]
+                )
+                isbn_set.update(chain(*known_books_isbn.values()))
+
+        self.feed_urls = book_urls if self.feed_complete else None
         return isbn_set
 
-    async def get_book_urls(self):
-        news_urls = await self.prepare_news_urls()
+    async def get_book_urls(self, watermark_urls):
+        """Return urls of all books in news feed, newest first.
 
+        Watermark holds all book urls of the feed seen by previous run. Pages
+        are read until the first known book, known books of remaining pages
+        are taken from watermark.
+        """
+        news_urls = await self.prepare_news_urls()
+        self.feed_complete = bool(news_urls)
+
+        if not watermark_urls:
+            book_url_tasks = [self.get_book_urls_on_page(news_url)
+                              for news_url in news_urls]
+
+            return self.join_news_pages(await asyncio.gather(*book_url_tasks))
+
+        # Newest books come first, read pages until one holds a known book.
+        known_urls = set(watermark_urls)
+        pages = []
+        for news_url in news_urls:
+            page_book_urls = await self.get_book_urls_on_page(news_url)
+            pages.append(page_book_urls)
+
+            # Failed page may hold new books, keep reading.
+            if page_book_urls is not None and not known_urls.isdisjoint(page_book_urls):
+                break
+
+        book_urls = self.join_news_pages(pages)
+        new_urls = [book_url for book_url in book_urls if book_url not in known_urls]
+        self.logger.info(f'Found {len(new_urls)} new books'
+                         f' on {len(pages)} of {len(news_urls)} news pages')
+
+        if len(pages) == len(news_urls) or not pages[-1]:
+            return book_urls
+
+        # Watermark keeps order of news feed, it is used from the last known
+        # book that was read up to the last book of feed.
+        last_page_book_urls = await self.get_book_urls_on_page(news_urls[-1])
+        if last_page_book_urls and last_page_book_urls[-1] in known_urls:
+            start = watermark_urls.index(next(book_url for book_url in reversed(book_urls)
+                                              if book_url in known_urls)) + 1
+            end = watermark_urls.index(last_page_book_urls[-1]) + 1
+            return self.join_news_pages([book_urls, watermark_urls[start:end],
+                                         last_page_book_urls])
+
+        # Happens when feed order changed, next watermark covers the whole feed again.
+        self.logger.info('Watermark does not reach end of news feed, reading all pages')
         book_url_tasks = [self.get_book_urls_on_page(news_url)
-                          for news_url in news_urls]
+                          for news_url in news_urls[len(pages):-1]]
+        return self.join_news_pages([book_urls, *await asyncio.gather(*book_url_tasks),
+                                     last_page_book_urls])
+
+    def join_news_pages(self, pages):
+        if any(page_book_urls is None for page_book_urls in pages):
+            self.feed_complete = False
+        return list(dict.fromkeys(chain(*(page_book_urls for page_book_urls in pages
+                                          if page_book_urls is not None))))
+
+    def store_watermark(self):
+        # Books of incomplete feed aren't marked as seen.
+        if self.feed_urls is None:
+            return
+        self.store_watermark_urls(self.feed_urls)
 
-        book_urls = await asyncio.gather(*book_url_tasks)
+    def get_watermark_urls(self):
+        with self.handler.session_scope() as session:
+            watermark = session.query(LibraryNewsWatermarkModel).get(self.library_id)
+            return watermark.book_urls if watermark else []
 
-        return list(chain(*book_urls))
+    def store_watermark_urls(self, book_urls):
+        with self.handler.session_scope() as session:
+            session.merge(LibraryNewsWatermarkModel(
+                library_id=self.library_id,
+                book_urls=book_urls,
+                created=datetime.utcnow(),
+            ))
 
     async def get_book_urls_on_page(self, news_url):
         base_url = self.config.get(f'libraries:{self.library_id}', 'base_url')
@@ -126,21 +424,14 @@ class Library5004(LibraryBase):
         selectors = self.config.getstruct(f'latest_books:{self.library_id}',
                                           'book_urls_query')
 
-        book_urls = []
-
         try:
-            async with self.session.get(news_url, raise_for_status=True) as response:
-                content = await response.read()
-
-                with bs4_scope(content) as news_page:
-                    for selector in selectors:
-                        book_urls.extend([f'{base_url}{a["href"]}' for a in news_page.select(selector)])
-
+            content = await self.latency.fetch(self.session, 'GET', news_url,
+                                               raise_for_status=True)
         except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             self.logger.error(f'Fetching book urls on page failed: {e}')
-            return []
+            return None
 
-        return book_urls
+        return await self.parser.run_async(parse_news_book_urls, content, base_url, selectors)
 
     async def prepare_news_urls(self):
         params = await self.prepare_news_url_params()
@@ -161,55 +452,38 @@ class Library5004(LibraryBase):
         }
 
         try:
-            async with self.session.get(news_url, raise_for_status=True) as response:
-                # Prepare params for generatig urls.
-                content = await response.read()
-                config = self.config[f'libraries:{self.library_id}']
-                with bs4_scope(content) as news_page:
-
-                    document_type_title = config['document_type_title']
-                    document_type = news_page.select_one(f'a[title="{document_type_title}"]')\
-                        .get('href', f'/news?{defaults["document_type"]}')\
-                        .replace('/news?', '')
-
-                    language_title = config['language_title']
-                    language = news_page.select_one(f'a[title="{language_title}"]')\
-                        .get('href', f'/news?{defaults["language"]}')\
-                        .replace('/news?', '')
-
-                    pagination_re = re.compile(config['pagination_value'])
-                    pagination = news_page.find('a', string=pagination_re)\
-                        .get('href', f'/news?{defaults["pagination"]}')\
-                        .replace('/news?', '')
+            content = await self.latency.fetch(self.session, 'GET', news_url,
+                                               raise_for_status=True)
         except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             self.logger.error(f'Fetching news url params failed: {e}')
-            document_type = defaults['document_type']
-            language = defaults['language']
-            pagination = defaults['pagination']
+            return defaults['document_type'], defaults['language'], defaults['pagination']
 
-        return document_type, language, pagination
+        # Prepare params for generatig urls.
+        config = self.config[f'libraries:{self.library_id}']
+        return await self.parser.run_async(parse_news_url_params,
+                                           content,
+                                           config['document_type_title'],
+                                           config['language_title'],
+                                           config['pagination_value'],
+                                           defaults)
 
     async def prepare_news_url_pagers(self, params):
         # Open page with params to calculate pager.
         news_url = self.news_url_template.format(*params, '')
 
         try:
-            async with self.session.get(news_url, raise_for_status=True) as response:
-                content = await response.read()
-                config = self.config[f'libraries:{self.library_id}']
-                with bs4_scope(content) as news_page:
-                    last_pager_re = re.compile(config['last_page_title'])
-                    last_pager_link = news_page.find('a', string=last_pager_re)
-                    if last_pager_link:
-                        last_pager = last_pager_link\
-                            .get('href', '')\
-                            .replace(news_url.replace(config['base_url'], ''), '')
-                    else:
-                        last_pager = None
+            content = await self.latency.fetch(self.session, 'GET', news_url,
+                                               raise_for_status=True)
         except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             self.logger.error(f'Fetching news urls failed: {e}')
             return []
 
+        config = self.config[f'libraries:{self.library_id}']
+        last_pager = await self.parser.run_async(parse_last_news_pager,
+                                                 content,
+                                                 config['last_page_title'],
+                                                 news_url.replace(config['base_url'], ''))
+
         if last_pager is None:
             return ['']
 
@@ -221,61 +495,70 @@ class Library5004(LibraryBase):
             for items in range(1, last_pager_items + per_page, per_page)
         ]
 
-    async def get_book_isbn(self, book_url):
-        # Check if current page info exists in DB.
-        isbn_list = self.get_book_isbn_from_db(book_url)
-        if isbn_list is not None:
-            return isbn_list
-
-        isbn_list = await self.get_book_isbn_from_link(book_url)
-
-        if isbn_list:
-            self.store_book_isbn(book_url, isbn_list)
-        return isbn_list
-
     async def get_book_isbn_from_link(self, book_url):
         try:
-            async with self.session.get(book_url, raise_for_status=True) as response:
-                content = await response.read()
-                with bs4_scope(content) as book_page:
-                    isbn_label = book_page.find('dt', string=re.compile(r'ISBN'))
-                    if not isbn_label:
-                        return []
-
-                    isbn_list_tag = isbn_label.find_next_sibling('dd')
-                    if not isbn_list_tag:
-                        return []
-
-                    isbn_list = [re.sub(r'\D+', '', child.string)
-                                 for child in isbn_list_tag.children
-                                 if child.string]
+            if self.incremental_parsing:
+                extractor = await self.latency.fetch(self.session, 'GET', book_url,
+                                                     read=BookIsbnExtractor.read_async,
+                                                     raise_for_status=True)
+                if extractor.done:
+                    return extractor.isbn_list
+                content = extractor.content
+            else:
+                content = await self.latency.fetch(self.session, 'GET', book_url,
+                                                   raise_for_status=True)
         except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             self.logger.error(f'Fetching book failed: {e}')
-            return []
+            return None
 
-        return isbn_list
+        return await self.parser.run_async(parse_book_isbn, content)
 
 
 class LatestBooksScraper:
+    """Match new books of many libraries with shelf books in one run.
+
+    Libraries are crawled concurrently on a single event loop with a shared
+    DNS resolver, shelf indexes are loaded once and matching books are
+    written separately for each library.
+    """
     logger = logging.getLogger(__name__)
-    libraries = {'4994': Library4949, '5004': Library5004}
+    # Libraries with news feed crawler.
+    libraries = {'5004': Library5004}
 
-    def __init__(self, library_id, profile_name, auth_data, refresh=False):
-        self.library = self.libraries.get(library_id)()
+    def __init__(self, library_ids, profile_name, auth_data, refresh=False, full=False):
         self.profile_name = profile_name
         self.refresh = refresh
         self.config = Config()
 
+        unsupported_ids = set(library_ids).difference(self.libraries)
+        if unsupported_ids:
+            raise LibraryNotSupported(f'Latest books of libraries {sorted(unsupported_ids)}'
+                                      ' are not supported')
+
+        self.handler = Handler()
+        self.handler.create_all()
+        self.library_instances = [
+            self.libraries[library_id](full=full, handler=self.handler)
+            for library_id in dict.fromkeys(library_ids)
+        ]
+
         self.search_shelf_name = self.config.get('latest_books_scraper',
                                                  'search_shelf_name')
-        self.search_file_path = shelf_name_to_file_path(self.profile_name,
-                                                        self.search_shelf_name)
 
         # Get library settings.
-        self.exclude_shelf_name = self.config.get(f'libraries:{library_id}',
-                                                  'shelf_name')
-        self.exclude_file_path = shelf_name_to_file_path(self.profile_name,
-                                                         self.exclude_shelf_name)
+        self.exclude_shelf_names = {
+            library.library_id: self.config.get(f'libraries:{library.library_id}',
+                                                'shelf_name')
+            for library in self.library_instances
+        }
+        # Shelf indexes are loaded once for all libraries.
+        self.shelf_isbn_indexes = {}
+
+        # Pages of all libraries are parsed by one executor.
+        self.parsing_mode = self.config.get('latest_books_scraper', 'parsing_mode',
+                                            fallback='inline')
+        self.parsing_workers = self.config.getint('latest_books_scraper', 'parsing_workers',
+                                                  fallback=cpu_count())
 
         # Authenticate to Google if auth data is available.
         if auth_data:
@@ -284,41 +567,87 @@ class LatestBooksScraper:
         else:
             self.google_client = None
 
-    def match_isbn_to_shelf_books(self, books_isbn):
+    async def get_libraries_books_isbn(self):
+        resolver = aiohttp.AsyncResolver()
+        try:
+            with ParsingExecutor(self.parsing_mode, self.parsing_workers) as parser,\
+                    LatencyPolicy() as latency:
+                for library in self.library_instances:
+                    library.parser = parser
+                    library.latency = latency
+
+                async with EventLoopMonitor() as loop_monitor:
+                    libraries_isbn = await asyncio.gather(*[
+                        library.get_books_isbn(resolver=resolver)
+                        for library in self.library_instances
+                    ])
+        finally:
+            await resolver.close()
+
+        self.logger.debug(f'Event loop lag: {loop_monitor}')
+        latency.log_metrics(self.logger)
+
+        return dict(zip(self.library_instances, libraries_isbn))
+
+    def match_isbn_to_shelf_books(self, library, books_isbn):
         if not books_isbn:
             return
 
-        with open(self.search_file_path, 'r') as search_books_file:
-            search_books = {
-                book['isbn']: book for book in
-                json.load(search_books_file)
-                if book['isbn'] is not None
-            }
+        # ISBN-10 and ISBN-13 forms of a book share the same index key.
+        books_isbn = set(map(normalize_isbn, books_isbn)).difference([None])
+
+        search_books = self.get_shelf_isbn_index(self.search_shelf_name)
         self.logger.info(f'Got {len(search_books)} books to search for')
 
-        with open(self.exclude_file_path, 'r') as exclude_books_file:
-            exclude_books = {
-                book['isbn']: book for book in
-                json.load(exclude_books_file)
-                if book['isbn'] is not None
-            }
+        exclude_books = self.get_shelf_isbn_index(self.exclude_shelf_names[library.library_id])
         self.logger.info(f'Got {len(exclude_books)} books to exclude from results')
 
         matching_books_isbn = set(search_books.keys())\
             .difference(exclude_books.keys())\
             .intersection(books_isbn)
 
-        self.logger.info(f'Got {len(matching_books_isbn)} matching books')
+        self.logger.info(f'Got {len(matching_books_isbn)} matching books in {library}')
 
         return [search_books[isbn] for isbn in matching_books_isbn]
 
-    def write_books_info(self, matching_books):
+    def get_shelf_isbn_index(self, shelf_name):
+        if shelf_name not in self.shelf_isbn_indexes:
+            self.shelf_isbn_indexes[shelf_name] = self.load_shelf_isbn_index(shelf_name)
+        return self.shelf_isbn_indexes[shelf_name]
+
+    def load_shelf_isbn_index(self, shelf_name):
+        with self.handler.session_scope() as session:
+            shelf_isbn_index = {
+                row.isbn: row.book for row in session
+                .query(ShelfIsbnIndexModel.isbn, ShelfIsbnIndexModel.book)
+                .filter(ShelfIsbnIndexModel.profile_name == self.profile_name.lower(),
+                        ShelfIsbnIndexModel.shelf_name == shelf_name)
+            }
+        if shelf_isbn_index:
+            return shelf_isbn_index
+
+        # Shelf was saved before the index existed, read its file instead.
+        self.logger.debug(f'Shelf "{shelf_name}" is not indexed, reading shelf file')
+        try:
+            with open(shelf_name_to_file_path(self.profile_name, shelf_name), 'r',
+                      encoding='utf-8') as shelf_books_file:
+                shelf_books = json.load(shelf_books_file)
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            raise BooksListUnavailable(e)
+
+        for book in shelf_books:
+            isbn = normalize_isbn(book.get('isbn'))
+            if isbn:
+                shelf_isbn_index.setdefault(isbn, book)
+        return shelf_isbn_index
+
+    def write_books_info(self, library, matching_books):
         if self.google_client:
-            self.write_books_info_to_google_drive(matching_books)
+            self.write_books_info_to_google_drive(library, matching_books)
         else:
-            self.write_books_info_to_xls(matching_books)
+            self.write_books_info_to_xls(library, matching_books)
 
-    def write_books_info_to_xls(self, matching_books):
+    def write_books_info_to_xls(self, library, matching_books):
         worksheet_headers = self.config.getstruct('latest_books_scraper',
                                                   'worksheet_headers')
         worksheet_name = f'{date.today()}'
@@ -327,14 +656,14 @@ class LatestBooksScraper:
 
         self.logger.debug('Writing books info to XLS file')
         make_xls(
-            file_name=f"{xls_file_name}{self.library.library_id}",
+            file_name=f"{xls_file_name}{library.library_id}",
             worksheet_name=worksheet_name,
             worksheet_headers=worksheet_headers,
             rows=matching_books,
         )
         self.logger.info('Books info written to XLS file')
 
-    def write_books_info_to_google_drive(self, matching_books):
+    def write_books_info_to_google_drive(self, library, matching_books):
         # Convert books info to spreadsheet rows.
         worksheet_headers = self.config.getstruct('latest_books_scraper',
                                                   'worksheet_headers')
@@ -344,7 +673,7 @@ class LatestBooksScraper:
         # Get workbook and worksheet title.
         workbook_title = self.config.get('latest_books_scraper', 'workbook_title')
         worksheet_title = self.config.get('latest_books_scraper', 'worksheet_title')\
-            .format(date.today())
+            .format(date.today(), library.library_id)
 
         self.logger.info('Writing books info to Google Drive')
         write_rows_to_worksheet(
@@ -358,23 +687,26 @@ class LatestBooksScraper:
     def run(self):
         # Refresh books list.
         if self.refresh:
-            for shelf_name in (self.search_shelf_name, self.exclude_shelf_name):
+            for shelf_name in dict.fromkeys([self.search_shelf_name,
+                                             *self.exclude_shelf_names.values()]):
                 self.logger.info(f'Updating list of books from shelf "{shelf_name}"')
                 CLIShelfScraper(profile_name=self.profile_name,
                                 shelf_name=shelf_name).run()
 
-        books_isbn = asyncio.run(self.library.get_books_isbn())
+        libraries_isbn = asyncio.run(self.get_libraries_books_isbn())
 
-        if not books_isbn:
-            self.logger.info('No new books found')
-            return
+        for library, books_isbn in libraries_isbn.items():
+            matching_books = self.match_isbn_to_shelf_books(library, books_isbn)
 
-        matching_books = self.match_isbn_to_shelf_books(books_isbn)
+            if not books_isbn:
+                self.logger.info(f'No books found in {library}')
+            elif matching_books:
+                self.write_books_info(library, matching_books)
+            else:
+                self.logger.info(f'No matching books found in {library}')
 
-        if matching_books:
-            self.write_books_info(matching_books)
-        else:
-            self.logger.info('No matching books found')
+            # Books are marked as seen only after results were written.
+            library.store_watermark()
 
 
 class CLILibraryBaseMixin:
@@ -382,24 +714,23 @@ class CLILibraryBaseMixin:
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # Counter is shared by all libraries crawled in one run.
         self.counter = None
 
-    async def get_books_isbn(self):
-        counter_title = 'Collecting books isbn '
-        with ProgressCounter(counter_title) as self.counter:
-            self.counter.update()
-            isbn_set = await super().get_books_isbn()
-        return isbn_set
-
     async def get_book_urls_on_page(self, news_url):
         urls_list = await super().get_book_urls_on_page(news_url)
         self.counter.next()
         return urls_list
 
+    async def prefetch_books_isbn(self, book_urls):
+        books_isbn = await super().prefetch_books_isbn(book_urls)
+        self.counter.next(len(books_isbn))
+        return books_isbn
+
     async def get_book_isbn(self, book_url):
-        isbn_list = await super().get_book_isbn(book_url)
+        book_isbn = await super().get_book_isbn(book_url)
         self.counter.next()
-        return isbn_list
+        return book_isbn
 
 
 class CLILibrary4949(CLILibraryBaseMixin, Library4949):
@@ -412,4 +743,13 @@ class CLILibrary5004(CLILibraryBaseMixin, Library5004):
 
 class CLILatestBooksScraper(LatestBooksScraper):
     logger = logging.getLogger('script')
-    libraries = {'4994': CLILibrary4949, '5004': CLILibrary5004}
+    libraries = {'5004': CLILibrary5004}
+
+    async def get_libraries_books_isbn(self):
+        counter_title = 'Collecting books isbn '
+        with ProgressCounter(counter_title) as counter:
+            counter.update()
+            for library in self.library_instances:
+                library.counter = counter
+            libraries_isbn = await super().get_libraries_books_isbn()
+        return libraries_isbn
@@ -4,11 +4,17 @@ import sys
 import json
 import logging
 import requests
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from urllib.parse import urljoin
 from datetime import datetime, timedelta
 from lib.db import BookLibraryAvailabilityModel, Handler
 from lib.automata import FirefoxBrowser
 from lib.config import Config
-from lib.utils import bs4_scope, get_file_path
+from lib.latency import LatencyPolicy
+from lib.catalog_mirror import CatalogMirror, parse_catalog_page
+from lib.utils import bs4_scope, chunked, get_file_path
 from lib.exceptions import BrowserUnavailable, LibraryNotSupported, LibraryPageNotValid
 from selenium.common.exceptions import (NoSuchElementException, WebDriverException,
                                         NoSuchWindowException, TimeoutException)
@@ -16,6 +22,21 @@ from selenium.webdriver.common.keys import Keys
 # }}}
 
 
+def parse_search_results(content, page_url, results_query, no_results_query):
+    """Return document urls of catalog search page, None when page isn't recognized."""
+    with bs4_scope(content) as search_page:
+        if search_page.select_one(no_results_query):
+            return []
+
+        results = search_page.select(results_query)
+        if not results:
+            return None
+
+        return [urljoin(page_url, book_anchor['href'])
+                for book_anchor in (result.find('a', href=True) for result in results)
+                if book_anchor]
+
+
 def library_factory(library_id, logger=None, invalidate_days=None):
     try:
         library = getattr(sys.modules.get(__name__), f'Library{library_id}')
@@ -38,27 +59,51 @@ class LibraryBase:  # {{{
         self.search_fields = self.config.getstruct('search_fields')
 
         self.invalidate_date = datetime.utcnow() - timedelta(days=self.invalidate_days)
+        # SQLite limits number of bound parameters in a single query.
+        self.query_chunk_size = 500
 
         self.handler = Handler()
         self.handler.create_all()
 
         self.session = None
+        self.latency = LatencyPolicy()
         self.browser = None
+        # Libraries searched over HTTP start browser only when it's needed.
+        self.browser_required = True
+        self.exit_stack = None
 
     def run(self):
-        with FirefoxBrowser() as self.browser, requests.Session() as self.session:
-            try:
-                # Open requested library page.
-                self.open_library_page()
-                # Fetch all books info.
-                books_info = self.get_books_info()
-            except (NoSuchWindowException, TimeoutException, WebDriverException) as e:
-                # Save error screenshot.
-                self.save_screenshot('error')
+        with self.browser_scope(), self.browser_errors():
+            # Fetch all books info.
+            return self.get_books_info()
+
+    @contextmanager
+    def browser_scope(self):
+        """Open HTTP session and browser with requested library page."""
+        with ExitStack() as self.exit_stack, requests.Session() as self.session,\
+                LatencyPolicy() as self.latency:
+            if self.browser_required:
+                self.start_browser()
+            yield self
+        self.browser = None
+        self.latency.log_metrics(self.logger)
 
-                raise BrowserUnavailable(e)
+    def start_browser(self):
+        self.browser = self.exit_stack.enter_context(FirefoxBrowser())
+        with self.browser_errors():
+            # Open requested library page.
+            self.open_library_page()
 
-        return books_info
+    @contextmanager
+    def browser_errors(self):
+        try:
+            yield
+        except (NoSuchWindowException, TimeoutException, WebDriverException) as e:
+            # Save error screenshot.
+            if self.browser is not None:
+                self.save_screenshot('error')
+
+            raise BrowserUnavailable(e)
 
     def save_screenshot(self, severity: str = 'info') -> None:
         timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
@@ -78,19 +123,48 @@ class LibraryBase:  # {{{
         books_info = []
 
         for book in self.books:
-            self.logger.debug(f"Start search '{book['title']}' by {book['author']}")
+            books_info.extend(self.get_book_entries(book))
+
+        return books_info
 
-            book_info = self.get_book_info(book)
+    def get_book_entries(self, book):
+        self.logger.debug(f"Start search '{book['title']}' by {book['author']}")
 
-            if book_info:
-                self.logger.info(f'Successfully queried "{book["title"]}" by {book["author"]}.')
-                books_info.append(book_info)
-            else:
-                self.logger.info(f'Book "{book["title"]}" by {book["author"]} not found.')
+        book_info = self.get_book_info(book)
 
-            self.logger.debug(f"End search '{book['title']}' by {book['author']}")
+        if book_info:
+            self.logger.info(f'Successfully queried "{book["title"]}" by {book["author"]}.')
+        else:
+            self.logger.info(f'Book "{book["title"]}" by {book["author"]} not found.')
+
+        self.logger.debug(f"End search '{book['title']}' by {book['author']}")
+
+        return book_info or []
+
+    def get_cached_books_info(self, books):
+        """Return cached entries of given books and list of books missing in cache."""
+        books_md5 = [BookLibraryAvailabilityModel.md5_from_book(book) for book in books]
+
+        search_results = {}
+        with self.handler.session_scope() as session:
+            for md5_chunk in chunked(list(set(books_md5)), self.query_chunk_size):
+                search_results.update(session.query(
+                    BookLibraryAvailabilityModel.book_md5,
+                    BookLibraryAvailabilityModel.search_results,
+                ).filter(
+                    BookLibraryAvailabilityModel.library_id == self.config['id'],
+                    BookLibraryAvailabilityModel.book_md5.in_(md5_chunk),
+                    BookLibraryAvailabilityModel.created >= self.invalidate_date,
+                ))
+
+        books_info, missing_books = [], []
+        for book, book_md5 in zip(books, books_md5):
+            if book_md5 in search_results:
+                books_info.extend(search_results[book_md5] or [])
+            else:
+                missing_books.append(book)
 
-        return [entry for result in books_info for entry in result]
+        return books_info, missing_books
 
     def get_book_info(self, book):
         book_md5 = BookLibraryAvailabilityModel.md5_from_book(book)
@@ -426,6 +500,19 @@ class Library5004(LibraryBase):  # {{{
     def __init__(self, books):
         super().__init__(library_id=5004, books=books)
 
+        # Books are resolved to documents with local catalog mirror first, it
+        # covers news feed acquisitions only, so misses go to catalog search.
+        self.catalog_mirror = self.config.getboolean('catalog_mirror', fallback=True)
+        self.catalog = CatalogMirror(library_id=5004, handler=self.handler)
+        # CSRF token is reused by all requests of the session until rejected.
+        self.yii_token = None
+        self.yii_token_lock = Lock()
+        # Limit of concurrent availability checks and document requests.
+        self.a11y_concurrency = self.config.getint('a11y_concurrency', fallback=8)
+        # Catalog is searched over HTTP, browser search is a fallback.
+        self.http_search = self.config.getboolean('http_search', fallback=True)
+        self.browser_required = not self.http_search
+
     def open_library_page(self):
         super().open_library_page()
 
@@ -438,6 +525,20 @@ class Library5004(LibraryBase):  # {{{
             pass
 
     def search_for_book(self, book):
+        if self.catalog_mirror:
+            book_info = self.search_catalog_mirror(book)
+            if book_info is not False:
+                return book_info
+
+        if self.http_search:
+            book_info = self.search_catalog_http(book)
+            if book_info is not False:
+                return book_info
+
+        # Browser is started only when HTTP search can't be used.
+        if self.browser is None:
+            self.start_browser()
+
         # Wait for submit button to be visible.
         try:
             self.browser.wait_is_visible_by_css(self.config['search_button_query'])
@@ -454,6 +555,89 @@ class Library5004(LibraryBase):  # {{{
 
         return book_info
 
+    def search_catalog_mirror(self, book):
+        """Return info of available mirrored book, False when it isn't decided.
+
+        Mirror holds only documents of news feed acquisitions and of previous
+        searches, not the full holdings, so live search runs both when book
+        isn't mirrored and when no mirrored item is available.
+        """
+        documents = self.catalog.find_documents(book)
+        if not documents:
+            return False
+
+        self.logger.debug(f'Found {len(documents)} mirrored documents'
+                          f' of "{book["title"]}" by {book["author"]}')
+        # Items of all documents are checked together, first available item wins.
+        book_info = self.scrape_first_book_info(
+            [item for document in documents for item in document['items']]
+        )
+
+        if not book_info:
+            self.logger.debug(f'No mirrored item of "{book["title"]}" is available,'
+                              ' searching catalog')
+            return False
+
+        return self.process_book_info(book, [book_info])
+
+    def search_catalog_http(self, book):
+        """Search catalog without browser, False when search page isn't recognized."""
+        if not ('title' in self.search_fields and book.get('title')):
+            return False
+
+        search_value = self.config['search_value_query'].format(book['title'], book['author'])
+        try:
+            response = self.latency.request(self.session, 'GET', self.config['search_url'], params={
+                self.config['search_query_param']: search_value,
+                # Display up to 100 results on page.
+                self.config['search_pagination_param']: self.config['pagination_value'],
+            })
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            self.logger.error(f'Error fetching url {self.config["search_url"]}: {e}')
+            return False
+
+        book_urls = parse_search_results(response.content, response.url,
+                                         self.config['search_results_query'],
+                                         self.config['no_results_query'])
+        if book_urls is None:
+            self.logger.warning(f'Search results of "{book["title"]}" not recognized,'
+                                ' searching with browser')
+            return False
+
+        book_info = self.scrape_book_info(book_urls)
+        return self.process_book_info(book, book_info or [])
+
+    def get_yii_token(self):
+        with self.yii_token_lock:
+            if not self.yii_token:
+                self.yii_token = self.fetch_yii_token()
+            return self.yii_token
+
+    def set_yii_token(self, yii_token):
+        # Token found on document page saves fetching catalog page.
+        with self.yii_token_lock:
+            if not self.yii_token:
+                self.yii_token = yii_token
+
+    def invalidate_yii_token(self, yii_token):
+        # Token may have been refreshed already by concurrent check.
+        with self.yii_token_lock:
+            if self.yii_token == yii_token:
+                self.yii_token = None
+
+    def fetch_yii_token(self):
+        try:
+            response = self.latency.request(self.session, 'GET', self.config['url'])
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            self.logger.error(f'Error fetching url {self.config["url"]}: {e}')
+            return None
+
+        with bs4_scope(response.content) as catalog_page:
+            token_tag = catalog_page.select_one(self.config['yii_token_query'])
+            return token_tag.get('value') if token_tag else None
+
     def set_search_value(self, search_value):
         # Input search value.
         search_input_query = self.config['search_input_query']
@@ -520,86 +704,117 @@ class Library5004(LibraryBase):  # {{{
             return
 
         book_info = None
-        for book_url in results:
-            try:
-                response = self.session.get(book_url)
-                response.raise_for_status()
-            except requests.exceptions.HTTPError as e:
-                self.logger.error(f'Error fetching url {book_url}: {e}')
-                continue
-
-            with bs4_scope(response.content) as book_page:
-                items_list = book_page.select(self.config['library_items_query'])
-                yii_token = book_page.select_one(self.config['yii_token_query']).get('value')
-                if not(items_list and yii_token):
-                    continue
-
-                book_info = self.scrape_first_book_info(
-                    yii_token=yii_token,
-                    items_list=items_list,
-                )
-                # All books are available in the same section.
-                if book_info:
-                    break
+        # Documents are fetched and checked in batches, so remaining documents
+        # aren't fetched once an available item is found.
+        for book_urls in chunked(results, self.a11y_concurrency):
+            with ThreadPoolExecutor(max_workers=len(book_urls)) as executor:
+                documents = [document for document in executor.map(self.get_document, book_urls)
+                             if document]
+
+            # Documents found by live search are added to catalog mirror.
+            if self.catalog_mirror:
+                self.catalog.store_documents(documents)
+
+            book_info = self.scrape_first_book_info(
+                [item for document in documents for item in document['items']]
+            )
+            # All books are available in the same section.
+            if book_info:
+                break
 
         return [book_info] if book_info else None
 
-    def scrape_first_book_info(self, yii_token, items_list):
-        book_info = None
+    def get_document(self, book_url):
+        try:
+            response = self.latency.request(self.session, 'GET', book_url)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            self.logger.error(f'Error fetching url {book_url}: {e}')
+            return None
 
-        for item in items_list:
-            # Check if book is available.
-            is_book_available = self.get_book_accessibility(yii_token, item)
-            if not is_book_available:
-                continue
+        document, yii_token = parse_catalog_page(book_url, response.content,
+                                                 self.catalog.parse_options)
+        if yii_token:
+            self.set_yii_token(yii_token)
+        return document
 
-            # Extract book location, section and availability from row.
-            item_signatures = item.select(self.config['location_details_query'])
-            if not item_signatures:
-                continue
+    def scrape_first_book_info(self, items):
+        accepted_locations = self.config.getstruct('accepted_locations')
 
-            signature_values = item_signatures[1].text.split()
+        # Only items in accepted locations are checked.
+        candidates = []
+        for item in items:
+            # Extract book location and section from item signature.
+            signature_values = (item['signature'] or '').split()
             # Skip books without section name.
             if len(signature_values) < 2:
                 continue
 
             # Check if address is in accepted list.
-            location = signature_values[0]
-            if location not in self.config.getstruct('accepted_locations'):
+            if signature_values[0] not in accepted_locations:
                 continue
 
             # Get full section name.
-            section = ' '.join(signature_values[1:])
-            book_info = (self.config['department'], section)
+            candidates.append((item, ' '.join(signature_values[1:])))
 
-            # All remaining available books will be in the same section.
-            break
+        if not candidates:
+            return None
 
-        return book_info
+        # Items are checked concurrently, first available item in order wins.
+        with ThreadPoolExecutor(max_workers=min(self.a11y_concurrency,
+                                                len(candidates))) as executor:
+            futures = [executor.submit(self.get_book_accessibility, item)
+                       for item, _ in candidates]
+            try:
+                for future, (item, section) in zip(futures, candidates):
+                    if future.result():
+                        # All remaining available books will be in the same section.
+                        return (self.config['department'], section)
+            finally:
+                # Checks of items after the available one aren't sent.
+                for future in futures:
+                    future.cancel()
+
+        return None
 
-    def get_book_accessibility(self, yii_token, item):
+    def get_book_accessibility(self, item):
         accessibility_url = '{0}/itemrequest/getiteminfomessage'.format(
             self.config['base_url']
         )
-        accessibility_params = {
-            "docid": item.get(self.config['a11y_docid_key']),
-            "doclibid": item.get(self.config['a11y_doclibid_key']),
-            'locationid': item.get(self.config['a11y_locationid_key']),
-            'accessibility': 1,
-            "YII_CSRF_TOKEN": yii_token,
-        }
-        accessibility_params['libid'] = accessibility_params['doclibid']
 
-        try:
-            response = self.session.post(
-                accessibility_url,
-                data=accessibility_params,
-                headers={'X-Requested-With': 'XMLHttpRequest'},
-            )
-            response.raise_for_status()
-        except requests.exceptions.HTTPError as e:
-            self.logger.error(f'Error fetching url {accessibility_url}: {e}')
-            return False
+        # Rejected token is refreshed once.
+        for attempt in range(2):
+            yii_token = self.get_yii_token()
+            if not yii_token:
+                return False
+
+            accessibility_params = {
+                "docid": item['docid'],
+                "doclibid": item['doclibid'],
+                'locationid': item['locationid'],
+                'accessibility': 1,
+                "YII_CSRF_TOKEN": yii_token,
+            }
+            accessibility_params['libid'] = accessibility_params['doclibid']
+
+            try:
+                response = self.latency.request(
+                    self.session,
+                    'POST',
+                    accessibility_url,
+                    data=accessibility_params,
+                    headers={'X-Requested-With': 'XMLHttpRequest'},
+                )
+                if response.status_code == 400 and not attempt:
+                    self.logger.debug('CSRF token rejected, refreshing token.')
+                    self.invalidate_yii_token(yii_token)
+                    continue
+                response.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                self.logger.error(f'Error fetching url {accessibility_url}: {e}')
+                return False
+
+            break
 
         with bs4_scope(response.content) as accessibility_result:
             accessibility_value = json.loads(
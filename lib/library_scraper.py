@@ -2,7 +2,7 @@ import concurrent.futures
 import datetime
 import json
 import logging
-import math
+import queue
 import re
 from operator import itemgetter
 
@@ -43,6 +43,9 @@ class LibraryScraper:
                                         fallback=5)
         self.retry_run = self.config.getint('library_scraper', 'selenium_retry_run',
                                             fallback=25)
+        # How many times a book is searched again after a browser failure.
+        self.book_retry_attempts = self.config.getint('library_scraper', 'book_retry_attempts',
+                                                      fallback=3)
 
     @property
     def shelf_name(self):
@@ -110,17 +113,33 @@ class LibraryScraper:
         shelf_books = self.shelf_books
         self.logger.info(f'Fetching {len(shelf_books)} books library info')
 
-        # Split shelf books into batches for worker nodes.
-        step_size = math.ceil(len(shelf_books) / self.nodes)
-        shelf_books_per_node = [shelf_books[i:i + step_size]
-                                for i in range(0, len(shelf_books), step_size)]
-        self.logger.debug(f'Built {len(shelf_books_per_node)} batches for nodes')
+        # Cached books are resolved before any browser is started.
+        books_info, missing_books = self.library_factory(books=[])\
+            .get_cached_books_info(shelf_books)
+        self.logger.info(f'Got {len(shelf_books) - len(missing_books)} cached books,'
+                         f' searching {len(missing_books)} books')
+        if missing_books:
+            books_info.extend(self.fetch_missing_books_info(missing_books))
+
+        # Sort books by deparment and section.
+        books_info.sort(key=itemgetter('department', 'section'))
+
+        return books_info
+
+    def fetch_missing_books_info(self, missing_books):
+        # Worker nodes pull books one at a time from a shared queue, so a
+        # node with slow books doesn't hold back the others.
+        books_queue = queue.Queue()
+        for book in missing_books:
+            books_queue.put((book, 0))
+        nodes = min(self.nodes, len(missing_books))
+        self.logger.debug(f'Starting {nodes} nodes for {len(missing_books)} books')
 
         # Fetch status using worker nodes.
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.nodes) as executor:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nodes) as executor:
             futures = concurrent.futures.wait([
-                executor.submit(self.fetch_books_info_using_node, book)
-                for book in shelf_books_per_node
+                executor.submit(self.fetch_books_info_using_node, books_queue)
+                for _ in range(nodes)
             ])
 
             books_info_from_nodes = []
@@ -130,41 +149,55 @@ class LibraryScraper:
                 else:
                     raise future.exception()
 
+        if not books_queue.empty():
+            self.logger.critical(f'Unable to search {books_queue.qsize()} books'
+                                 f' in library {self.library_id}')
+
         # Join results from nodes into a single list.
-        books_info = [
+        return [
             book_info
             for books_info_batch in books_info_from_nodes
             for book_info in books_info_batch
         ]
 
-        # Sort books by deparment and section.
-        books_info.sort(key=itemgetter('department', 'section'))
-
-        return books_info
-
-    def fetch_books_info_using_node(self, shelf_books_for_node):
-        # Work, work?
-        if not shelf_books_for_node:
-            return
+    def fetch_books_info_using_node(self, books_queue):
+        books_info = []
 
-        # Get library instance.
-        self.logger.debug('Creating library instance')
-        library = self.library_factory(books=shelf_books_for_node)
-
-        # Fetch books info
-        self.logger.debug('Running library search')
+        # Crashed browser is replaced, books completed by node are kept.
         retry_run = self.retry_run
-        while retry_run:
+        while retry_run and not books_queue.empty():
+            # Get library instance.
+            self.logger.debug('Creating library instance')
+            library = self.library_factory(books=[])
             try:
-                return library.run()
+                with library.browser_scope():
+                    self.logger.debug('Running library search')
+                    self.fetch_queued_books_info(library, books_queue, books_info)
             except BrowserUnavailable as e:
                 self.logger.error(f'Restarting browser due to: {e}.')
             finally:
                 retry_run -= 1
 
-        # All retries have failed.
-        self.logger.critical(f"Unable to search library {self.library_id}")
-        return []
+        return books_info
+
+    def fetch_queued_books_info(self, library, books_queue, books_info):
+        while True:
+            try:
+                book, attempt = books_queue.get_nowait()
+            except queue.Empty:
+                return
+
+            try:
+                with library.browser_errors():
+                    books_info.extend(library.get_book_entries(book))
+            except BrowserUnavailable:
+                # Failed book is searched again by any node.
+                if attempt < self.book_retry_attempts:
+                    books_queue.put((book, attempt + 1))
+                else:
+                    self.logger.error(f'Giving up search of "{book["title"]}"'
+                                      f' by {book["author"]}')
+                raise
 
     def write_books_info(self, books_info):
         if self.google_client:
@@ -0,0 +1,155 @@
+import re
+import asyncio
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from lxml import etree
+
+
+class ParsingExecutor:
+    """Run CPU bound page parsing inline, on a thread pool or on a process pool.
+
+    Parsing functions must be module level functions taking raw page content
+    and plain values and returning extracted values only, so they can be
+    sent to worker processes.
+    """
+    modes = ('inline', 'thread', 'process')
+
+    def __init__(self, mode='inline', workers=None):
+        if mode not in self.modes:
+            raise ValueError(f'Unknown parsing mode "{mode}", choose from {self.modes}')
+
+        self.mode = mode
+        self.workers = workers
+        self.executor = None
+
+    def __enter__(self):
+        if self.mode == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        elif self.mode == 'process':
+            # Spawned workers don't inherit locks held by scraper threads.
+            self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context('spawn'))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def run(self, func, *args):
+        if self.executor is None:
+            return func(*args)
+        return self.executor.submit(func, *args).result()
+
+    async def run_async(self, func, *args):
+        if self.executor is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+
+class IncrementalExtractor:
+    """Extract values from a page while it is downloaded.
+
+    Response chunks are fed to an lxml pull parser and reading stops as soon
+    as subclass `handle` sets `done`. When page ends before all values were
+    found, `content` holds the whole page for a full parse.
+
+    Connection of response closed before its end can't be reused, so rest
+    of the page up to `drain_size` bytes is read and dropped, and only pages
+    with longer rest are closed early.
+    """
+    chunk_size = 16 * 1024
+    drain_size = 512 * 1024
+    charset_re = re.compile(r'charset=["\']?([\w-]+)', re.I)
+
+    def __init__(self):
+        self.parser = None
+        self.chunks = []
+        self.done = False
+        self.failed = False
+
+    @property
+    def content(self):
+        return b''.join(self.chunks)
+
+    @property
+    def bytes_read(self):
+        return sum(map(len, self.chunks))
+
+    def start(self, content_type):
+        charset = self.charset_re.search(content_type or '')
+        self.parser = etree.HTMLPullParser(events=('start', 'end'),
+                                           encoding=charset.group(1) if charset else 'utf-8')
+
+    def feed(self, chunk):
+        self.chunks.append(chunk)
+        if self.failed:
+            return False
+
+        try:
+            self.parser.feed(chunk)
+            for event, element in self.parser.read_events():
+                if isinstance(element.tag, str):
+                    self.handle(event, element)
+                if self.done:
+                    break
+        except (etree.LxmlError, LookupError):
+            # Keep reading, page will be parsed as a whole.
+            self.failed = True
+
+        return self.done
+
+    def handle(self, event, element):
+        raise NotImplementedError()
+
+    def should_drain(self, content_length):
+        # Rest of body is unknown for chunked responses, it is drained up to the limit.
+        try:
+            return int(content_length) - self.bytes_read <= self.drain_size
+        except (TypeError, ValueError):
+            return True
+
+    @classmethod
+    def read(cls, response):
+        """Read streamed `requests` response until values are found."""
+        extractor = cls()
+        extractor.start(response.headers.get('Content-Type'))
+        with response:
+            chunks = response.iter_content(cls.chunk_size)
+            for chunk in chunks:
+                if extractor.feed(chunk):
+                    break
+
+            if extractor.done and extractor.should_drain(response.headers.get('Content-Length')):
+                drained = 0
+                for chunk in chunks:
+                    drained += len(chunk)
+                    if drained > cls.drain_size:
+                        break
+        return extractor
+
+    @classmethod
+    async def read_async(cls, response):
+        """Read aiohttp response until values are found."""
+        extractor = cls()
+        extractor.start(response.headers.get('Content-Type'))
+        chunks = response.content.iter_chunked(cls.chunk_size)
+        async for chunk in chunks:
+            if extractor.feed(chunk):
+                break
+
+        if extractor.done and extractor.should_drain(response.headers.get('Content-Length')):
+            drained = 0
+            async for chunk in chunks:
+                drained += len(chunk)
+                if drained > cls.drain_size:
+                    break
+        return extractor
+
+    @staticmethod
+    def has_class(element, class_name):
+        return class_name in (element.get('class') or '').split()
+
+    @staticmethod
+    def text(element):
+        return ''.join(element.itertext())
@@ -0,0 +1,194 @@
+import json
+import logging
+import aiohttp
+import asyncio
+from json import JSONDecodeError
+from datetime import datetime, timedelta
+from lib.db import BookPriceModel, ProfileModel, ShelfSnapshotModel, Handler
+from lib.config import Config
+from lib.latency import LatencyPolicy
+from lib.utils import chunked, ProgressBar, shelf_name_to_file_path
+from lib.exceptions import BooksListUnavailable
+
+
+class PriceScraper:
+    """Book prices lookup backed by a cache keyed by ISBN.
+
+    Cached prices are used until `price_invalidate_days` pass, missing prices
+    are fetched concurrently from the retailer widget. Failed lookups leave
+    book price empty instead of failing the whole shelf.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, force=False, handler=None):
+        self.force = force
+        self.config = Config()['shelf_scraper']
+
+        invalidate_days = self.config.getint('price_invalidate_days', fallback=7)
+        self.invalidate_date = datetime.utcnow() - timedelta(days=invalidate_days)
+        self.concurrency = self.config.getint('price_concurrency', fallback=8)
+        self.query_chunk_size = 500
+
+        self.handler = handler or Handler()
+        self.handler.create_all()
+
+        self.session = None
+        self.semaphore = None
+        self.latency = LatencyPolicy()
+
+    def set_book_prices(self, books):
+        asyncio.run(self.update_book_prices(books))
+
+    async def update_book_prices(self, books):
+        loop = asyncio.get_running_loop()
+
+        isbn_list = [book['isbn'] for book in books if book.get('isbn')]
+        prices = ({} if self.force else
+                  await loop.run_in_executor(None, self.get_prices_from_db, isbn_list))
+
+        # Books sharing ISBN are priced once, books without ISBN one by one.
+        missing_books = list({
+            book.get('isbn') or id(book): book
+            for book in books if book.get('isbn') not in prices
+        }.values())
+        self.logger.debug(f'Got {len(prices)} cached prices,'
+                          f' fetching {len(missing_books)} prices')
+
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        async with aiohttp.ClientSession() as self.session:
+            fetched_prices = await asyncio.gather(*[
+                self.get_book_price(book) for book in missing_books
+            ])
+        self.latency.log_metrics(self.logger)
+
+        fresh_prices = {}
+        for book, book_price in zip(missing_books, fetched_prices):
+            prices[book.get('isbn') or id(book)] = book_price
+            if book_price is not None and book.get('isbn'):
+                fresh_prices[book['isbn']] = book_price
+        await loop.run_in_executor(None, self.store_prices, fresh_prices)
+
+        for book in books:
+            book['price'] = prices.get(book.get('isbn') or id(book))
+
+    def get_prices_from_db(self, isbn_list):
+        prices = {}
+        with self.handler.session_scope() as session:
+            for isbn_chunk in chunked(list(set(isbn_list)), self.query_chunk_size):
+                prices.update(session.query(BookPriceModel.isbn, BookPriceModel.price).filter(
+                    BookPriceModel.isbn.in_(isbn_chunk),
+                    BookPriceModel.created >= self.invalidate_date,
+                ))
+        return prices
+
+    def store_prices(self, prices):
+        if not prices:
+            return
+
+        created = datetime.utcnow()
+        with self.handler.session_scope() as session:
+            for isbn_chunk in chunked(list(prices), self.query_chunk_size):
+                session.query(BookPriceModel).filter(
+                    BookPriceModel.isbn.in_(isbn_chunk),
+                ).delete(synchronize_session=False)
+            session.bulk_insert_mappings(BookPriceModel, [{
+                'isbn': isbn,
+                'price': price,
+                'created': created,
+            } for isbn, price in prices.items()])
+
+    async def get_book_price(self, book):
+        try:
+            async with self.semaphore:
+                content = await self.latency.fetch(self.session, 'GET', self.config['bb_url'],
+                                                   params=self.get_book_price_params(book),
+                                                   raise_for_status=True)
+
+            book_price = self.parse_book_price(json.loads(content))
+        except (aiohttp.ClientError, asyncio.TimeoutError, JSONDecodeError) as e:
+            self.logger.error(f'Fetching price of "{book["title"]}" failed: {e}')
+            return None
+
+        return book_price
+
+    def get_book_price_params(self, book):
+        return {
+            'name': book['title'],
+            'info': book['author'],
+            'number': book.get('isbn') or '',
+            'skip_jQuery': '1',
+        }
+
+    def parse_book_price(self, price_info):
+        if not price_info.get('status'):
+            return 0.0
+
+        return self.find_retailer_book_price(price_info)
+
+    def find_retailer_book_price(self, price_info):
+        entries = (price_info['data'].values()
+                   if type(price_info['data']) is dict
+                   else price_info['data'])
+
+        book_price = 0.0
+        retailer_choices = self.config.getstruct('retailers')
+        for entry in entries:
+            has_retailer_price = (
+                entry.get('type', '') == 'book'
+                and entry.get('name', '') in retailer_choices
+            )
+            if not has_retailer_price:
+                continue
+
+            book_price = float(entry.get('price', book_price))
+            break
+
+        return book_price
+
+    def refresh(self, profile_name, shelf_name):
+        """Update prices of books in shelf files written by shelf scraper."""
+        for shelf_name in self.get_shelf_names(profile_name, shelf_name):
+            file_path = shelf_name_to_file_path(profile_name, shelf_name)
+            try:
+                with open(file_path, 'r', encoding='utf-8') as file_handle:
+                    shelf_books = json.load(file_handle)
+            except (FileNotFoundError, JSONDecodeError) as e:
+                raise BooksListUnavailable(e)
+
+            self.logger.info(f'Refreshing prices of {len(shelf_books)} books'
+                             f' on shelf {shelf_name}')
+            self.set_book_prices(shelf_books)
+
+            with open(file_path, 'w', encoding='utf-8') as file_handle:
+                json.dump(shelf_books, file_handle, ensure_ascii=False, indent=2)
+
+    def get_shelf_names(self, profile_name, shelf_name):
+        if shelf_name != 'all':
+            return [shelf_name]
+
+        # Use shelves stored by previous shelf scraper runs.
+        with self.handler.session_scope() as session:
+            return [row.shelf_name for row in session
+                    .query(ShelfSnapshotModel.shelf_name)
+                    .join(ProfileModel, ProfileModel.profile_id == ShelfSnapshotModel.profile_id)
+                    .filter(ProfileModel.profile_name == profile_name.lower())
+                    .order_by(ShelfSnapshotModel.shelf_name)]
+
+
+class CLIPriceScraper(PriceScraper):
+    logger = logging.getLogger('script')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bar = None
+
+    async def update_book_prices(self, books):
+        bar_title = 'Collecting book prices'
+        with ProgressBar(bar_title, max=len(books)) as self.bar:
+            await super().update_book_prices(books)
+            self.bar.goto(self.bar.max)
+
+    async def get_book_price(self, book):
+        book_price = await super().get_book_price(book)
+        self.bar.next()
+        return book_price
@@ -1,73 +1,358 @@
 import re
 import json
 import logging
+import asyncio
+import aiohttp
+import queue
+import threading
 import requests
 from json import JSONDecodeError
 from urllib.parse import urlparse
-from requests.exceptions import HTTPError, ConnectionError
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
 from datetime import datetime, timedelta
+from hashlib import md5
 from multiprocessing import cpu_count
 from multiprocessing.dummy import Pool, Lock
-from lib.db import BookShelfInfoModel, Handler
-from lib.utils import bs4_scope, ProgressBar
+from functools import partial
+from lib.db import (BookShelfInfoModel, ProfileModel, ShelfSnapshotModel,
+                    ShelfPageJournalModel, ShelfIsbnIndexModel, Handler)
+from lib.utils import (bs4_scope, chunked, normalize_isbn, retry_call, retry_call_async,
+                       ProgressBar)
 from lib.config import Config
+from lib.price_scraper import PriceScraper, CLIPriceScraper
 from lib.utils import shelf_name_to_file_path
+from lib.parsing import ParsingExecutor, IncrementalExtractor
+from lib.latency import LatencyPolicy
 from lib.exceptions import ProfileNotFoundError, ShelvesScrapeError, BooksCollectError,\
     DatabaseError
 
+ISBN_SUB_RE = re.compile(r'[^\dX]+')
+
+
+def clean_isbn(text):
+    # Keep ISBN-10 check character X in either case, strip everything else.
+    return ISBN_SUB_RE.sub('', text.upper())
+
+
+def split_title(title):
+    # Search for subtitle in title.
+    if '.' in title:
+        title, subtitle = title.split('.', maxsplit=1)
+        return title, subtitle
+    return title, None
+
+
+def parse_listing_page(content, lc_url):
+    with bs4_scope(content) as pager_page:
+        listing_books = []
+        for link in pager_page.select('div#booksFilteredListPaginator'
+                                      ' a.authorAllBooks__singleTextTitle'):
+            book_tag = link.find_parent('div', class_='authorAllBooks__singleText')
+            author_tag = (book_tag.select_one('div.authorAllBooks__singleTextAuthor > a')
+                          if book_tag else None)
+
+            title, subtitle = split_title(link.text.strip())
+            listing_books.append({
+                'title': title,
+                'subtitle': subtitle,
+                'author': author_tag.text.strip() if author_tag else None,
+                'url': f'{lc_url}{link["href"]}',
+            })
+    return listing_books
+
+
+def parse_book_page(book_url, content):
+    with bs4_scope(content) as book_page:
+        # Get title and author.
+        title = book_page.select_one(
+            'div.title-container'
+        )['data-title']
+        author = book_page.select_one(
+            'span.author > a.link-name'
+        ).text.strip()
+
+        # Search for subtitle in title.
+        title, subtitle = split_title(title)
+
+        # Get details element.
+        book_details = book_page.select_one('div#book-details')
+
+        # Get original title.
+        original_title_tag = book_details.select_one(
+            'dt:-soup-contains("Tytuł oryginału") + dd'
+        )
+        original_title = (original_title_tag.text.strip()
+                          if original_title_tag else None)
+
+        # Get pages count.
+        pages_count_tag = book_details.select_one(
+            'dt:-soup-contains("Liczba stron") + dd'
+        )
+        pages_count = (pages_count_tag.text.strip()
+                       if pages_count_tag else None)
+
+        # Get category.
+        category = book_page.select_one('a.book__category').text.strip()
+
+        # Get release date.
+        release_tag = book_details.select_one(
+            'dt:-soup-contains("Data wydania") + dd'
+        )
+        release = (release_tag.text.strip() if release_tag else None)
+
+        # Get book ISBN. ISBN is not always present.
+        isbn_tag = book_details.select_one(
+            'dt:-soup-contains("ISBN") + dd'
+        )
+        isbn = (clean_isbn(isbn_tag.text) if isbn_tag else None)
+
+    return {
+        'title': title,
+        'subtitle': subtitle,
+        'original_title': original_title,
+        'author': author,
+        'category': category,
+        'pages': pages_count,
+        'url': book_url,
+        'isbn': isbn,
+        'release': release,
+    }
+
+
+class BookPageExtractor(IncrementalExtractor):
+    """Extract fields of `parse_book_page` and stop after the book details block."""
+    detail_labels = {
+        'original_title': 'Tytuł oryginału',
+        'pages': 'Liczba stron',
+        'release': 'Data wydania',
+        'isbn': 'ISBN',
+    }
+
+    def __init__(self):
+        super().__init__()
+        self.values = {}
+        self.details = None
+
+    def handle(self, event, element):
+        if event == 'start':
+            if ('title' not in self.values and element.tag == 'div'
+                    and self.has_class(element, 'title-container')
+                    and element.get('data-title') is not None):
+                self.values['title'] = element.get('data-title')
+            return
+
+        parent = element.getparent()
+        if element.tag == 'a' and 'author' not in self.values\
+                and self.has_class(element, 'link-name')\
+                and parent is not None and parent.tag == 'span'\
+                and self.has_class(parent, 'author'):
+            self.values['author'] = self.text(element).strip()
+        elif element.tag == 'a' and 'category' not in self.values\
+                and self.has_class(element, 'book__category'):
+            self.values['category'] = self.text(element).strip()
+        elif element.tag == 'div' and self.details is None\
+                and element.get('id') == 'book-details':
+            self.details = self.parse_details(element)
+
+        self.done = (self.details is not None
+                     and all(field in self.values for field in ('title', 'author', 'category')))
+
+    def parse_details(self, book_details):
+        details = dict.fromkeys(self.detail_labels)
+        for field, label in self.detail_labels.items():
+            # Same as "dt:-soup-contains(label) + dd" selector.
+            for label_tag in book_details.iter('dt'):
+                value_tag = label_tag.getnext()
+                if label in self.text(label_tag) and value_tag is not None\
+                        and value_tag.tag == 'dd':
+                    details[field] = self.text(value_tag)
+                    break
+
+        return {
+            field: (value if value is None
+                    else clean_isbn(value) if field == 'isbn'
+                    else value.strip())
+            for field, value in details.items()
+        }
+
+    def get_book_info(self, book_url):
+        title, subtitle = split_title(self.values['title'])
+        return {
+            'title': title,
+            'subtitle': subtitle,
+            'original_title': self.details['original_title'],
+            'author': self.values['author'],
+            'category': self.values['category'],
+            'pages': self.details['pages'],
+            'url': book_url,
+            'isbn': self.details['isbn'],
+            'release': self.details['release'],
+        }
+
 
 class ShelfScraper:
     logger = logging.getLogger(__name__)
-
-    def __init__(self, profile_name, shelf_name, include_price=False):
+    price_scraper_class = PriceScraper
+    # Fields available on the shelf listing page.
+    listing_fields = ('title', 'subtitle', 'author', 'url')
+    # Fields available on the book details page.
+    book_fields = ('title', 'subtitle', 'original_title', 'author', 'category',
+                   'pages', 'url', 'isbn', 'release')
+
+    def __init__(self, profile_name, shelf_name, include_price=False, fields=None,
+                 incremental=False, resume=False, handler=None):
         self.profile_name = profile_name
         self.shelf_name = shelf_name
         self.include_price = include_price
+        # Sync shelves against snapshots stored by previous runs.
+        self.incremental = incremental
+        # Reuse shelf pages journaled by a failed previous run.
+        self.resume = resume
+
+        # Build book records from chosen fields only.
+        if fields is not None:
+            fields = list(dict.fromkeys(['url', *fields]))
+            # Price lookup needs these fields.
+            if include_price:
+                fields.extend(field for field in ('title', 'author', 'isbn')
+                              if field not in fields)
+        self.fields = fields
+        # Book details page is fetched only for fields missing on listing page.
+        self.fetch_book_details = (fields is None
+                                   or not set(fields).issubset(self.listing_fields))
 
         self.config = Config()['shelf_scraper']
-        self.isbn_sub_re = re.compile(r'\D+')
+
+        # Pages are parsed inline, on a thread pool or on a process pool.
+        self.parsing_mode = self.config.get('parsing_mode', fallback='inline')
+        self.parsing_workers = self.config.getint('parsing_workers', fallback=cpu_count())
+        # Book pages are read only until book fields are found.
+        self.incremental_parsing = self.config.getboolean('incremental_parsing', fallback=True)
 
         invalidate_days = self.config.getint('invalidate_days', fallback=30)
         self.invalidate_date = datetime.utcnow() - timedelta(days=invalidate_days)
-
-        self.handler = Handler()
+        # Books cached before invalidate date are used while being refreshed
+        # in background, until they get older than `max_stale_days`.
+        max_stale_days = self.config.getint('max_stale_days', fallback=invalidate_days)
+        self.max_stale_date = datetime.utcnow() - timedelta(days=max(max_stale_days,
+                                                                     invalidate_days))
+        self.revalidate_concurrency = self.config.getint('revalidate_concurrency',
+                                                         fallback=2)
+        # Refreshes still pending after the run are waited for up to this
+        # many seconds, the rest is dropped and picked up by the next run.
+        self.revalidate_timeout = self.config.getfloat('revalidate_timeout', fallback=10.0)
+
+        # Number of fetched books written to cache in one transaction.
+        self.cache_batch_size = self.config.getint('cache_batch_size', fallback=100)
+        # SQLite limits number of bound parameters in a single query.
+        self.query_chunk_size = 500
+
+        # Limits of the shelf pages -> book pages pipeline.
+        self.pages_queue_size = self.config.getint('pages_queue_size', fallback=cpu_count())
+        self.books_queue_size = self.config.getint('books_queue_size', fallback=100)
+        self.pipeline_timeout = 0.5
+
+        # Failed pages and books are retried before the shelf fails.
+        self.retry_attempts = self.config.getint('retry_attempts', fallback=3)
+        self.retry_backoff = self.config.getfloat('retry_backoff', fallback=1.0)
+
+        # Handler may be shared by scrapers running in one process.
+        self.handler = handler or Handler()
         self.handler.create_all()
 
         self.profile_id = None
         self.shelves = None
+        # Books collected in current run, shared by all shelves.
+        self.books_info = {}
+        self.listing_books = {}
+        self.book_records = {}
+        self.listing_page_size = 0
+        # Snapshots of synced shelves and shelves found unchanged.
+        self.shelf_snapshots = {}
+        self.unchanged_shelf_ids = set()
+        self.journal_pages = {}
         self.session = None
+        self.latency = LatencyPolicy()
         self.pool = None
+        self.pages_pool = None
+        self.revalidator = None
+        self.parser = ParsingExecutor()
 
     def run(self):
-        with requests.Session() as self.session:
-            # Fetch profile id for given name
-            try:
-                self.profile_id = self.get_profile_id()
-            except ProfileNotFoundError as e:
-                self.logger.error(f'Profile search failed: {e}')
-                return
+        # Listing pages and book pages are fetched by separate pools that are
+        # shared by all shelves for the whole run.
+        with self.make_session() as self.session,\
+                LatencyPolicy() as self.latency,\
+                Pool(processes=cpu_count()) as self.pages_pool,\
+                Pool(processes=(cpu_count() * 2)) as self.pool,\
+                ParsingExecutor(self.parsing_mode, self.parsing_workers) as self.parser,\
+                BooksRevalidator(self) as self.revalidator:
+            self.scrape()
+        self.latency.log_metrics(self.logger)
+
+    def scrape(self):
+        # Fetch profile id for given name
+        try:
+            self.profile_id = self.get_profile_id()
+        except ProfileNotFoundError as e:
+            self.logger.error(f'Profile search failed: {e}')
+            return
 
-            try:
-                self.shelves = self.get_book_shelves()
-            except ShelvesScrapeError as e:
-                self.logger.error(f'Shelf "{self.shelf_name}" not found: {e}')
-                return
+        try:
+            self.shelves = self.get_book_shelves()
+        except ShelvesScrapeError as e:
+            self.logger.error(f'Shelf "{self.shelf_name}" not found: {e}')
+            return
 
-            # Fetch books from given shelves.
-            try:
-                self.get_books()
-            except (BooksCollectError, DatabaseError) as e:
-                self.logger.error(e)
-                return
+        # Fetch books from given shelves.
+        try:
+            self.get_books()
+        except (BooksCollectError, DatabaseError) as e:
+            self.logger.error(e)
+            return
+
+    @staticmethod
+    def make_session():
+        session = requests.Session()
+        # Keep a connection for every thread of the books pool.
+        adapter = HTTPAdapter(pool_maxsize=cpu_count() * 2)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
 
     def get_profile_id(self):
-        return self.match_profile_by_name(self.search_for_profile())
+        if self.incremental:
+            profile_id = self.get_profile_id_from_db()
+            if profile_id:
+                self.logger.info(f'Using stored id {profile_id} of profile "{self.profile_name}"')
+                return profile_id
+
+        profile_id = self.match_profile_by_name(self.search_for_profile())
+        self.store_profile_id(profile_id)
+        return profile_id
+
+    def get_profile_id_from_db(self):
+        with self.handler.session_scope() as session:
+            return session.query(ProfileModel.profile_id).filter(
+                ProfileModel.profile_name == self.profile_name.lower(),
+            ).scalar()
+
+    def store_profile_id(self, profile_id):
+        with self.handler.session_scope() as session:
+            session.merge(ProfileModel(
+                profile_name=self.profile_name.lower(),
+                profile_id=profile_id,
+                created=datetime.utcnow(),
+            ))
 
     def search_for_profile(self):
         self.logger.info(f'Searching for profile "{self.profile_name}"')
         try:
             # Query user.
-            response = self.session.post(
+            response = self.latency.request(
+                self.session,
+                'POST',
                 self.config['lc_profile_search_url'],
                 data={'phrase': self.profile_name},
                 headers={'X-Requested-With': 'XMLHttpRequest'},
@@ -75,14 +360,17 @@ class ShelfScraper:
             response.raise_for_status()
 
             # Parse json response.
-            response_json = response.json()
-            search_results = response_json['data']['content']
-            self.logger.debug(f'Got search results: {bool(search_results)}')
-        except (HTTPError, JSONDecodeError, KeyError) as e:
+            search_results = self.parse_profile_search(response.json())
+        except (RequestException, JSONDecodeError, KeyError) as e:
             raise ProfileNotFoundError(f'HTML request error: {e}')
 
         return search_results
 
+    def parse_profile_search(self, response_json):
+        search_results = response_json['data']['content']
+        self.logger.debug(f'Got search results: {bool(search_results)}')
+        return search_results
+
     def match_profile_by_name(self, search_results):
         self.logger.debug('Matching profile in search results')
 
@@ -121,18 +409,11 @@ class ShelfScraper:
                          if self.shelf_name != 'all'
                          else 'Fetching all book shelves')
         try:
-            response = self.session.get(self.get_profile_library_url())
+            response = self.latency.request(self.session, 'GET',
+                                            self.get_profile_library_url())
             response.raise_for_status()
-            with bs4_scope(response.content) as profile_library:
-                # Select single shelf or all shelves.
-                shelves_selector = 'ul.filtr__wrapItems'
-                if self.shelf_name != 'all':
-                    shelves_selector += f' input[data-shelf-name="{self.shelf_name}"]'
-                else:
-                    shelves_selector += ' input[name="shelfs[]"]'
-
-                shelf_tags = profile_library.select(shelves_selector)
-        except HTTPError as e:
+            shelf_tags = self.parse_shelf_tags(response.content)
+        except RequestException as e:
             raise ShelvesScrapeError(f'HTML request error: {e}')
 
         if not shelf_tags:
@@ -140,38 +421,39 @@ class ShelfScraper:
 
         return shelf_tags
 
-    def build_book_shelves_from_shelf_tags(self, shelf_tags):
-        book_shelves = []
-        for shelf_tag in shelf_tags:
-            shelf_id = shelf_tag['value']
-            shelf_name = shelf_tag['data-shelf-name']
-            shelf_url = self.get_shelf_url(shelf_id)
+    def parse_shelf_tags(self, content):
+        with bs4_scope(content) as profile_library:
+            # Select single shelf or all shelves.
+            shelves_selector = 'ul.filtr__wrapItems'
+            if self.shelf_name != 'all':
+                shelves_selector += f' input[data-shelf-name="{self.shelf_name}"]'
+            else:
+                shelves_selector += ' input[name="shelfs[]"]'
 
-            try:
-                self.logger.debug(f'Fetching "{shelf_name}" shelf page at {shelf_url}')
-                response = self.session.get(shelf_url)
-                response.raise_for_status()
-                with bs4_scope(response.content) as shelf_page:
-                    self.logger.debug(f'Fetching "{shelf_name}" pager info')
-                    last_pager_tag = shelf_page.select_one(
-                        'ul#buttonPaginationListP'
-                        '> li.page-item:nth-last-child(2)'
-                        '> a.page-link'
-                    )
-                    pager_count = (int(last_pager_tag['data-pager-page'])
-                                   if last_pager_tag else 1)
-            except HTTPError as e:
-                raise ShelvesScrapeError(f'HTML request error: {e}')
-
-            shelf = {
-                'id': shelf_id,
-                'name': shelf_name,
-                'pager_count': pager_count,
-            }
-            self.logger.debug(f'Shelf info: {shelf}')
+            # Keep only tag attributes so the parsed page can be released.
+            return [{'value': shelf_tag['value'],
+                     'data-shelf-name': shelf_tag['data-shelf-name']}
+                    for shelf_tag in profile_library.select(shelves_selector)]
+
+    def build_book_shelves_from_shelf_tags(self, shelf_tags):
+        # Shelves with stored snapshots don't need pager info.
+        if self.incremental:
+            self.shelf_snapshots = self.get_shelf_snapshots(
+                [shelf_tag['value'] for shelf_tag in shelf_tags]
+            )
 
-            # Append shelf info.
-            book_shelves.append(shelf)
+        # Fetch pager info of all remaining shelves in parallel.
+        book_shelves = iter(self.pages_pool.map(self.get_book_shelf, [
+            shelf_tag for shelf_tag in shelf_tags
+            if shelf_tag['value'] not in self.shelf_snapshots
+        ]))
+        book_shelves = [
+            self.make_shelf(shelf_tag['value'], shelf_tag['data-shelf-name'],
+                            self.shelf_snapshots[shelf_tag['value']]['pager_count'])
+            if shelf_tag['value'] in self.shelf_snapshots
+            else next(book_shelves)
+            for shelf_tag in shelf_tags
+        ]
 
         self.logger.info(f'Found shelf matching "{self.shelf_name}"'
                          if self.shelf_name != 'all'
@@ -179,51 +461,351 @@ class ShelfScraper:
 
         return book_shelves
 
+    def get_book_shelf(self, shelf_tag):
+        shelf_id = shelf_tag['value']
+        shelf_name = shelf_tag['data-shelf-name']
+        shelf_url = self.get_shelf_url(shelf_id)
+
+        try:
+            self.logger.debug(f'Fetching "{shelf_name}" shelf page at {shelf_url}')
+            response = self.latency.request(self.session, 'GET', shelf_url)
+            response.raise_for_status()
+            self.logger.debug(f'Fetching "{shelf_name}" pager info')
+            pager_count = self.parse_pager_count(response.content)
+        except RequestException as e:
+            raise ShelvesScrapeError(f'HTML request error: {e}')
+
+        return self.make_shelf(shelf_id, shelf_name, pager_count)
+
+    def parse_pager_count(self, content):
+        with bs4_scope(content) as shelf_page:
+            last_pager_tag = shelf_page.select_one(
+                'ul#buttonPaginationListP'
+                '> li.page-item:nth-last-child(2)'
+                '> a.page-link'
+            )
+            return (int(last_pager_tag['data-pager-page'])
+                    if last_pager_tag else 1)
+
+    def make_shelf(self, shelf_id, shelf_name, pager_count):
+        shelf = {
+            'id': shelf_id,
+            'name': shelf_name,
+            'pager_count': pager_count,
+        }
+        self.logger.debug(f'Shelf info: {shelf}')
+        return shelf
+
     def get_books(self):
+        shelves_books = self.get_shelves_books(self.shelves)
+
+        if self.include_price:
+            # Books found on many shelves are priced once.
+            self.set_book_prices(list({
+                book['url']: book
+                for shelf_books in shelves_books.values()
+                for book in shelf_books
+            }.values()))
+
         for shelf in self.shelves:
-            with Pool(processes=(cpu_count())) as self.pool:
-                self.logger.debug(f'Fetching "{shelf["name"]}" shelf books')
-                shelf_book_urls = self.get_shelf_book_urls(shelf)
+            shelf_books = shelves_books[shelf['id']]
 
-            if not shelf_book_urls:
-                self.logger.warning(f'No books found on shelf {shelf["name"]}')
+            if shelf['id'] in self.unchanged_shelf_ids:
+                self.logger.info(f'Shelf {shelf["name"]} unchanged since last run')
                 continue
-            self.logger.debug(f'Shelf book urls: {shelf_book_urls}')
-
-            with Pool(processes=(cpu_count() * 2)) as self.pool:
-                shelf_books = self.get_books_from_urls(shelf_book_urls)
-                self.logger.debug(f'Shelf books: {shelf_books}')
 
-                if self.include_price:
-                    self.set_book_prices(shelf_books)
+            if not shelf_books:
+                self.logger.warning(f'No books found on shelf {shelf["name"]}')
+                continue
+            self.logger.debug(f'Shelf "{shelf["name"]}" books: {shelf_books}')
 
             self.sort_books_list(shelf_books)
             self.save_books_list(shelf['name'], shelf_books)
-
-    def get_shelf_book_urls(self, shelf):
+            self.store_shelf_isbn_index(shelf['name'], shelf_books)
+
+        self.store_shelf_snapshots([
+            (shelf, self.shelves_book_urls[shelf['id']]) for shelf in self.shelves
+            if shelf['id'] not in self.unchanged_shelf_ids
+        ])
+        # Shelves were written, pages journal is not needed anymore.
+        self.clear_journal_pages([shelf['id'] for shelf in self.shelves])
+
+    def get_shelves_books(self, shelves):
+        """Fetch books from all shelves in a producer/consumer pipeline.
+
+        Pages of all shelves are fetched by the pages pool and passed through
+        a bounded queue. Book pages are scheduled on the shared books pool as
+        soon as the first listing page arrives, with number of not yet
+        collected books limited by `books_queue_size`. A book present on many
+        shelves is fetched once.
+
+        Failed pages and books are retried with backoff. Collected pages are
+        journaled and fetched books cached in batches, so a failed run can be
+        resumed without fetching them again.
+        """
+        self.shelves_book_urls = {shelf['id']: [] for shelf in shelves}
+        self.pages_queue = queue.Queue(maxsize=self.pages_queue_size)
+        self.pending_books = threading.Semaphore(self.books_queue_size)
+        self.pipeline_stop = threading.Event()
+
+        producer = threading.Thread(target=self.put_shelf_pages, args=(shelves,), daemon=True)
+        producer.start()
+
+        fetched_books = []
+        try:
+            for book_info in self.pool.imap_unordered(partial(self.retry,
+                                                              self.get_book_info_by_url),
+                                                      self.iter_missing_book_urls()):
+                self.pending_books.release()
+                self.books_info[book_info['url']] = book_info
+                fetched_books.append(book_info)
+                # Write fresh results back in batches.
+                if len(fetched_books) >= self.cache_batch_size:
+                    self.store_books_info(fetched_books)
+                    fetched_books = []
+        finally:
+            # Unblock producer and consumer when pipeline was interrupted.
+            self.pipeline_stop.set()
+            self.pending_books.release()
+            producer.join()
+            self.store_books_info(fetched_books)
+
+        return {
+            shelf_id: [self.get_book_record(book_url) for book_url in shelf_book_urls]
+            for shelf_id, shelf_book_urls in self.shelves_book_urls.items()
+        }
+
+    def put_shelf_pages(self, shelves):
+        synced_shelves = [shelf for shelf in shelves if shelf['id'] in self.shelf_snapshots]
         pages_info = [json.dumps({'page': page, 'shelf_id': shelf['id']})
+                      for shelf in shelves if shelf['id'] not in self.shelf_snapshots
                       for page in range(1, shelf['pager_count'] + 1)]
 
-        shelf_book_urls = [
-            book_url
-            for book_urls in self.pool.map(self.get_page_book_urls, pages_info)
-            for book_url in book_urls
-        ]
-        return shelf_book_urls
+        try:
+            if self.resume:
+                self.journal_pages = self.get_journal_pages([
+                    shelf['id'] for shelf in shelves if shelf['id'] not in self.shelf_snapshots
+                ])
+
+            synced_book_urls = self.pages_pool.imap(self.sync_shelf_book_urls, synced_shelves)
+            book_urls_per_page = self.pages_pool.imap(self.get_journaled_page_book_urls,
+                                                      pages_info)
+
+            for shelf, book_urls in zip(synced_shelves, synced_book_urls):
+                if not self.put_pipeline_item((shelf['id'], book_urls)):
+                    return
+
+            for page_info_json, book_urls in zip(pages_info, book_urls_per_page):
+                shelf_id = json.loads(page_info_json)['shelf_id']
+                if not self.put_pipeline_item((shelf_id, book_urls)):
+                    return
+        except Exception as e:
+            # Pass error to the consumer thread.
+            self.put_pipeline_item(e)
+        else:
+            self.put_pipeline_item(None)
+
+    def sync_shelf_book_urls(self, shelf):
+        """Update shelf books from its stored snapshot.
+
+        Listing pages are read from the first one until a page holding only
+        known books is found; books below it are taken from the snapshot.
+        Last shelf page is read too, snapshot books are used only when they
+        end with it at the same offset, so books removed below the read pages
+        are not missed.
+        """
+        snapshot = self.shelf_snapshots[shelf['id']]
+        known_urls = [book['url'] for book in snapshot['books']]
+
+        book_urls = []
+        last_page_book_urls = None
+        fetched_pages = 0
+        page = 1
+        while True:
+            page_book_urls = self.retry(
+                self.get_page_book_urls, json.dumps({'page': page, 'shelf_id': shelf['id']})
+            )
+            fetched_pages += 1
+
+            if page == 1:
+                last_page_book_urls = self.get_last_page_book_urls(shelf, page_book_urls)
+                fetched_pages += shelf['pager_count'] > 1
+
+            # Unchanged first and last page mean no books were added, reordered or removed.
+            if (page == 1
+                    and snapshot['page_hashes'][:1] == [self.page_hash(page_book_urls)]
+                    and self.ends_with_last_page(shelf, known_urls, last_page_book_urls)):
+                self.logger.debug(f'Shelf "{shelf["name"]}" first and last page unchanged')
+                self.unchanged_shelf_ids.add(shelf['id'])
+                shelf['synced_pages'] = fetched_pages
+                return []
+
+            book_urls.extend(book_url for book_url in page_book_urls
+                             if book_url not in book_urls)
+
+            # End of shelf listing.
+            if not page_book_urls:
+                break
+
+            if set(page_book_urls).issubset(known_urls):
+                last_known_index = known_urls.index(page_book_urls[-1])
+                synced_book_urls = book_urls + [book_url
+                                                for book_url in known_urls[last_known_index + 1:]
+                                                if book_url not in book_urls]
+                # Remaining shelf pages didn't change.
+                if self.ends_with_last_page(shelf, synced_book_urls, last_page_book_urls):
+                    self.store_listing_books(snapshot['books'])
+                    book_urls = synced_book_urls
+                    break
+
+            page += 1
+
+        shelf['synced_pages'] = fetched_pages
+        added_urls = set(book_urls).difference(known_urls)
+        removed_urls = set(known_urls).difference(book_urls)
+        self.logger.info(f'Synced shelf "{shelf["name"]}" from {fetched_pages} pages:'
+                         f' {len(added_urls)} added, {len(removed_urls)} removed')
+
+        return book_urls
+
+    def get_last_page_book_urls(self, shelf, first_page_book_urls):
+        if shelf['pager_count'] <= 1:
+            return first_page_book_urls
+        return self.retry(self.get_page_book_urls,
+                          json.dumps({'page': shelf['pager_count'], 'shelf_id': shelf['id']}))
+
+    def ends_with_last_page(self, shelf, book_urls, last_page_book_urls):
+        # Last page starts at fixed offset, any removal above it shifts its books.
+        last_page_offset = (shelf['pager_count'] - 1) * self.listing_page_size
+        return book_urls[last_page_offset:] == last_page_book_urls
+
+    def page_hash(self, book_urls):
+        return md5(json.dumps([self.listing_books[book_url] for book_url in book_urls],
+                              sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_shelf_snapshots(self, shelf_ids):
+        with self.handler.session_scope() as session:
+            return {
+                snapshot.shelf_id: {
+                    'pager_count': snapshot.pager_count,
+                    'books': snapshot.books,
+                    'page_hashes': snapshot.page_hashes,
+                }
+                for snapshot in session.query(ShelfSnapshotModel).filter(
+                    ShelfSnapshotModel.profile_id == self.profile_id,
+                    ShelfSnapshotModel.shelf_id.in_(shelf_ids),
+                )
+            }
+
+    def store_shelf_snapshots(self, shelves_book_urls):
+        page_size = self.listing_page_size or 1
+        with self.handler.session_scope() as session:
+            for shelf, book_urls in shelves_book_urls:
+                pages = chunked(book_urls, page_size)
+                session.merge(ShelfSnapshotModel(
+                    profile_id=self.profile_id,
+                    shelf_id=shelf['id'],
+                    shelf_name=shelf['name'],
+                    pager_count=len(pages) or 1,
+                    books=[self.listing_books[book_url] for book_url in book_urls],
+                    page_hashes=[self.page_hash(page_book_urls) for page_book_urls in pages],
+                    created=datetime.utcnow(),
+                ))
+
+    def retry(self, func, *args):
+        return retry_call(func, *args, exceptions=(BooksCollectError,),
+                          attempts=self.retry_attempts, backoff=self.retry_backoff)
+
+    def get_journaled_page_book_urls(self, page_info_json):
+        page_info = json.loads(page_info_json)
+        journal_key = (page_info['shelf_id'], page_info['page'])
+        if journal_key in self.journal_pages:
+            # Journaled pages are checked too, they give page size of snapshots.
+            return self.store_listing_books(self.check_page_books(self.journal_pages[journal_key],
+                                                                  page_info))
+
+        book_urls = self.retry(self.get_page_book_urls, page_info_json)
+        self.store_journal_page(page_info, book_urls)
+        return book_urls
+
+    def get_journal_pages(self, shelf_ids):
+        with self.handler.session_scope() as session:
+            return {
+                (journal_page.shelf_id, journal_page.page): journal_page.books
+                for journal_page in session.query(ShelfPageJournalModel).filter(
+                    ShelfPageJournalModel.profile_id == self.profile_id,
+                    ShelfPageJournalModel.shelf_id.in_(shelf_ids),
+                )
+            }
+
+    def store_journal_page(self, page_info, book_urls):
+        with self.handler.session_scope() as session:
+            session.merge(ShelfPageJournalModel(
+                profile_id=self.profile_id,
+                shelf_id=page_info['shelf_id'],
+                page=page_info['page'],
+                books=[self.listing_books[book_url] for book_url in book_urls],
+                created=datetime.utcnow(),
+            ))
+
+    def clear_journal_pages(self, shelf_ids):
+        with self.handler.session_scope() as session:
+            session.query(ShelfPageJournalModel).filter(
+                ShelfPageJournalModel.profile_id == self.profile_id,
+                ShelfPageJournalModel.shelf_id.in_(shelf_ids),
+            ).delete(synchronize_session=False)
+
+    def put_pipeline_item(self, item):
+        while not self.pipeline_stop.is_set():
+            try:
+                self.pages_queue.put(item, timeout=self.pipeline_timeout)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def iter_missing_book_urls(self):
+        scheduled_urls = set()
+        while not self.pipeline_stop.is_set():
+            try:
+                page_item = self.pages_queue.get(timeout=self.pipeline_timeout)
+            except queue.Empty:
+                continue
+
+            if page_item is None:
+                return
+            if isinstance(page_item, Exception):
+                raise page_item
+
+            shelf_id, book_urls = page_item
+            self.shelves_book_urls[shelf_id].extend(book_urls)
+            if not self.fetch_book_details:
+                continue
+
+            self.books_info.update(self.get_books_info_from_db([
+                book_url for book_url in book_urls if book_url not in self.books_info
+            ]))
+
+            for book_url in book_urls:
+                if book_url in self.books_info or book_url in scheduled_urls:
+                    continue
+                scheduled_urls.add(book_url)
+
+                # Wait until there is room for another book.
+                self.pending_books.acquire()
+                if self.pipeline_stop.is_set():
+                    return
+                yield book_url
 
     def get_page_book_urls(self, page_info_json):
         try:
             page_info = json.loads(page_info_json)
-            data = {
-                'page': page_info['page'],
-                'listId': 'booksFilteredList',
-                'shelfs[]': page_info['shelf_id'],
-                'objectId': self.profile_id,
-                'own': 0,
-            }
+            data = self.get_page_request_data(page_info)
             self.logger.debug(f'Requesting page {self.config["lc_shelf_page_url"]}'
                               f' with data {data}')
-            response = self.session.post(
+            response = self.latency.request(
+                self.session,
+                'POST',
                 self.config['lc_shelf_page_url'],
                 data=data,
                 headers={'X-Requested-With': 'XMLHttpRequest'},
@@ -231,166 +813,168 @@ class ShelfScraper:
             response.raise_for_status()
 
             # Parse json response.
-            response_json = response.json()
-            response_content = response_json['data']['content']
-            self.logger.debug(f'Got page content: {bool(response_content)}')
-
-            # Parse HTML response part.
-            with bs4_scope(response_content) as pager_page:
-                book_urls = [
-                    f'{self.config["lc_url"]}{link["href"]}'
-                    for link in pager_page.select(
-                        'div#booksFilteredListPaginator'
-                        ' a.authorAllBooks__singleTextTitle'
-                    )
-                ]
-                self.logger.debug(f'Found {len(book_urls)} urls on page {page_info["page"]}')
+            book_urls = self.store_listing_books(
+                self.parse_page_books(response.json(), page_info)
+            )
         except JSONDecodeError as e:
             raise BooksCollectError(f'JSON error: {e}')
-        except HTTPError as e:
+        except RequestException as e:
             raise BooksCollectError(f'HTML request error: {e}')
 
         return book_urls
 
-    def get_books_from_urls(self, shelf_book_urls):
-        shelf_books = self.pool.map(self.get_book_info, shelf_book_urls)
-        return shelf_books
+    def get_page_request_data(self, page_info):
+        return {
+            'page': page_info['page'],
+            'listId': 'booksFilteredList',
+            'shelfs[]': page_info['shelf_id'],
+            'objectId': self.profile_id,
+            'own': 0,
+        }
+
+    def parse_page_books(self, response_json, page_info):
+        response_content = response_json['data']['content']
+        self.logger.debug(f'Got page content: {bool(response_content)}')
+
+        # Parse HTML response part.
+        return self.check_page_books(
+            self.parser.run(parse_listing_page, response_content, self.config['lc_url']),
+            page_info,
+        )
+
+    def check_page_books(self, listing_books, page_info):
+        self.logger.debug(f'Found {len(listing_books)} urls on page {page_info["page"]}')
+        self.listing_page_size = max(self.listing_page_size, len(listing_books))
+
+        return listing_books
+
+    def store_listing_books(self, listing_books):
+        for listing_book in listing_books:
+            self.listing_books.setdefault(listing_book['url'], listing_book)
+        return [listing_book['url'] for listing_book in listing_books]
+
+    def get_book_record(self, book_url):
+        if book_url not in self.book_records:
+            book_info = (self.books_info[book_url]
+                         if self.fetch_book_details
+                         else self.listing_books[book_url])
+            self.book_records[book_url] = (
+                book_info if self.fields is None
+                else {field: book_info.get(field) for field in self.fields}
+            )
+        return self.book_records[book_url]
 
     def get_book_info(self, book_url):
         # Check if current book info exists in DB.
-        with self.handler.session_scope() as session:
-            book_info = session.query(BookShelfInfoModel.book_info).filter(
-                BookShelfInfoModel.url_md5 == BookShelfInfoModel.md5_from_url(book_url),
-                BookShelfInfoModel.created >= self.invalidate_date,
-            ).scalar()
-
+        book_info = self.get_books_info_from_db([book_url]).get(book_url)
         if book_info:
             return book_info
 
         book_info = self.get_book_info_by_url(book_url)
-        with self.handler.session_scope() as session:
-            session.query(BookShelfInfoModel).filter(
-                BookShelfInfoModel.url_md5 == BookShelfInfoModel.md5_from_url(book_url),
-            ).delete(synchronize_session=False)
-            session.add(BookShelfInfoModel(
-                url_md5=BookShelfInfoModel.md5_from_url(book_url),
-                book_info=book_info,
-            ))
+        self.store_books_info([book_info])
 
         return book_info
 
+    def get_books_info_from_db(self, book_urls):
+        urls_by_md5 = {BookShelfInfoModel.md5_from_url(book_url): book_url
+                       for book_url in book_urls}
+
+        books_info = {}
+        stale_book_urls = []
+        with self.handler.session_scope() as session:
+            for url_md5_chunk in chunked(list(urls_by_md5), self.query_chunk_size):
+                rows = session.query(BookShelfInfoModel.url_md5,
+                                     BookShelfInfoModel.book_info,
+                                     BookShelfInfoModel.created)\
+                    .filter(BookShelfInfoModel.url_md5.in_(url_md5_chunk),
+                            BookShelfInfoModel.created >= self.max_stale_date)
+                for row in rows:
+                    if not row.book_info:
+                        continue
+                    books_info[urls_by_md5[row.url_md5]] = row.book_info
+                    if row.created < self.invalidate_date:
+                        stale_book_urls.append(urls_by_md5[row.url_md5])
+
+        if stale_book_urls:
+            self.revalidate_books_info(stale_book_urls)
+
+        return books_info
+
+    def revalidate_books_info(self, book_urls):
+        self.revalidator.put(book_urls)
+
+    def revalidate_book_info(self, book_url):
+        try:
+            # Skip progress reporting of subclasses, refresh runs in background.
+            return ShelfScraper.get_book_info_by_url(self, book_url)
+        except BooksCollectError as e:
+            self.logger.warning(f'Refreshing stale book {book_url} failed: {e}')
+            return None
+
+    def store_books_info(self, books_info):
+        if not books_info:
+            return
+
+        rows = {BookShelfInfoModel.md5_from_url(book_info['url']): book_info
+                for book_info in books_info}
+        created = datetime.utcnow()
+        with self.handler.session_scope() as session:
+            for url_md5_chunk in chunked(list(rows), self.query_chunk_size):
+                session.query(BookShelfInfoModel).filter(
+                    BookShelfInfoModel.url_md5.in_(url_md5_chunk),
+                ).delete(synchronize_session=False)
+            session.bulk_insert_mappings(BookShelfInfoModel, [{
+                'url_md5': url_md5,
+                'book_info': book_info,
+                'created': created,
+            } for url_md5, book_info in rows.items()])
+
     def get_book_info_by_url(self, book_url):
         try:
-            response = self.session.get(book_url)
+            response = self.latency.request(self.session, 'GET', book_url,
+                                            stream=self.incremental_parsing)
             response.raise_for_status()
-            with bs4_scope(response.content) as book_page:
-                # Get title and author.
-                title = book_page.select_one(
-                    'div.title-container'
-                )['data-title']
-                author = book_page.select_one(
-                    'span.author > a.link-name'
-                ).text.strip()
-
-                # Search for subtitle in title.
-                subtitle = None
-                if '.' in title:
-                    title, subtitle = title.split('.', maxsplit=1)
-
-                # Get details element.
-                book_details = book_page.select_one('div#book-details')
-
-                # Get original title.
-                original_title_tag = book_details.select_one(
-                    'dt:-soup-contains("Tytuł oryginału") + dd'
-                )
-                original_title = (original_title_tag.text.strip()
-                                  if original_title_tag else None)
-
-                # Get pages count.
-                pages_count_tag = book_details.select_one(
-                    'dt:-soup-contains("Liczba stron") + dd'
-                )
-                pages_count = (pages_count_tag.text.strip()
-                               if pages_count_tag else None)
-
-                # Get category.
-                category = book_page.select_one('a.book__category').text.strip()
-
-                # Get release date.
-                release_tag = book_details.select_one(
-                    'dt:-soup-contains("Data wydania") + dd'
-                )
-                release = (release_tag.text.strip() if release_tag else None)
-
-                # Get book ISBN. ISBN is not always present.
-                isbn_tag = book_details.select_one(
-                    'dt:-soup-contains("ISBN") + dd'
-                )
-                isbn = (self.isbn_sub_re.sub('', isbn_tag.text) if isbn_tag else None)
-
-                book_info = {
-                    'title': title,
-                    'subtitle': subtitle,
-                    'original_title': original_title,
-                    'author': author,
-                    'category': category,
-                    'pages': pages_count,
-                    'url': book_url,
-                    'isbn': isbn,
-                    'release': release,
-                }
-        except (HTTPError, JSONDecodeError) as e:
+            if self.incremental_parsing:
+                extractor = BookPageExtractor.read(response)
+                book_info = (extractor.get_book_info(book_url) if extractor.done
+                             else self.parse_book_info(book_url, extractor.content))
+            else:
+                book_info = self.parse_book_info(book_url, response.content)
+        except (RequestException, JSONDecodeError) as e:
             raise BooksCollectError(f'HTML request error: {e}')
 
         return book_info
 
-    def set_book_prices(self, shelf_books):
-        self.pool.map(self.set_book_price, shelf_books)
-
-    def set_book_price(self, book):
-        try:
-            response = self.session.get(
-                self.config['bb_url'],
-                params={
-                    'name': book['title'],
-                    'info': book['author'],
-                    'number': book['isbn'],
-                    'skip_jQuery': '1',
-                },
-            )
-            response.raise_for_status()
-
-            price_info = json.loads(response.text)
-            if not price_info.get('status'):
-                book['price'] = 0.0
-                return
+    def parse_book_info(self, book_url, content):
+        return self.parser.run(parse_book_page, book_url, content)
 
-            book_price = self.find_retailer_book_price(price_info)
-        except (HTTPError, ConnectionError, JSONDecodeError) as e:
-            raise BooksCollectError(f'HTML request error: {e}')
+    def store_shelf_isbn_index(self, shelf_name, shelf_books):
+        """Index saved shelf books by ISBN-13 for matching with library books."""
+        # Keep previous index when books were collected without isbn.
+        if self.fields is not None and 'isbn' not in self.fields:
+            return
 
-        book['price'] = book_price
+        books_by_isbn = {}
+        for book in shelf_books:
+            isbn = normalize_isbn(book.get('isbn'))
+            if isbn:
+                books_by_isbn.setdefault(isbn, book)
 
-    def find_retailer_book_price(self, price_info):
-        entries = (price_info['data'].values()
-                   if type(price_info['data']) is dict
-                   else price_info['data'])
-
-        book_price = 0.0
-        retailer_choices = self.config.getstruct('retailers')
-        for entry in entries:
-            has_retailer_price = (
-                entry.get('type', '') == 'book'
-                and entry.get('name', '') in retailer_choices
-            )
-            if not has_retailer_price:
-                continue
-
-            book_price = float(entry.get('price', book_price))
-            break
+        with self.handler.session_scope() as session:
+            session.query(ShelfIsbnIndexModel).filter(
+                ShelfIsbnIndexModel.profile_name == self.profile_name.lower(),
+                ShelfIsbnIndexModel.shelf_name == shelf_name,
+            ).delete(synchronize_session=False)
+            session.bulk_insert_mappings(ShelfIsbnIndexModel, [{
+                'profile_name': self.profile_name.lower(),
+                'shelf_name': shelf_name,
+                'isbn': isbn,
+                'book': book,
+                'created': datetime.utcnow(),
+            } for isbn, book in books_by_isbn.items()])
 
-        return book_price
+    def set_book_prices(self, shelf_books):
+        self.price_scraper_class(handler=self.handler).set_book_prices(shelf_books)
 
     def sort_books_list(self, shelf_books):
         self.logger.debug('Sorting books')
@@ -419,19 +1003,514 @@ class ShelfScraper:
                 else f'{self.config["lc_profile_url"]}/{path}')
 
 
+class BooksRevalidator:
+    """Refresh stale cached books in background.
+
+    Book urls are fetched by a separate pool of `revalidate_concurrency`
+    threads while the scraper goes on with stale data, fresh results are
+    written back in batches. Pending refreshes are finished on exit within
+    `revalidate_timeout` seconds, remaining ones are dropped.
+    """
+
+    def __init__(self, scraper):
+        self.scraper = scraper
+        self.logger = scraper.logger
+        self.book_urls_queue = queue.Queue()
+        self.scheduled_urls = set()
+        self.stopped = threading.Event()
+        self.refreshed_count = 0
+        self.pool = None
+        self.thread = None
+
+    def __enter__(self):
+        self.pool = Pool(processes=self.scraper.revalidate_concurrency)
+        self.thread = threading.Thread(target=self.refresh_books_info, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.book_urls_queue.put(None)
+        self.thread.join(self.scraper.revalidate_timeout)
+        self.pool.close()
+        if self.thread.is_alive():
+            # Queued books are skipped, daemon threads fetching the rest are
+            # abandoned and their books stay stale until the next run.
+            self.stopped.set()
+            self.logger.info(f'Refreshing stale books exceeded time budget, abandoned'
+                             f' {len(self.scheduled_urls) - self.refreshed_count} of'
+                             f' {len(self.scheduled_urls)} refreshes')
+            return
+        self.pool.join()
+
+    def put(self, book_urls):
+        for book_url in book_urls:
+            if book_url in self.scheduled_urls:
+                continue
+            self.scheduled_urls.add(book_url)
+            self.book_urls_queue.put(book_url)
+
+    def refresh_books_info(self):
+        fetched_books = []
+        try:
+            for book_info in self.pool.imap_unordered(self.revalidate_book_info,
+                                                      iter(self.book_urls_queue.get, None)):
+                if book_info is None:
+                    continue
+                fetched_books.append(book_info)
+                if len(fetched_books) >= self.scraper.cache_batch_size:
+                    self.scraper.store_books_info(fetched_books)
+                    self.refreshed_count += len(fetched_books)
+                    fetched_books = []
+            self.scraper.store_books_info(fetched_books)
+            self.refreshed_count += len(fetched_books)
+        except DatabaseError as e:
+            self.logger.error(f'Storing refreshed books failed: {e}')
+
+        if self.scheduled_urls and not self.stopped.is_set():
+            self.logger.info(f'Refreshed {self.refreshed_count} of'
+                             f' {len(self.scheduled_urls)} stale books')
+
+    def revalidate_book_info(self, book_url):
+        if self.stopped.is_set():
+            return None
+        return self.scraper.revalidate_book_info(book_url)
+
+
+class ShelfScraperBatch:
+    """Scrape many profile shelves in one process.
+
+    Shelves listed in the manifest are scraped one after another with a
+    shared HTTP session, worker pools, database handler and collected books,
+    so a book present on shelves of many profiles is fetched once.
+    """
+    logger = logging.getLogger(__name__)
+    scraper_class = ShelfScraper
+
+    def __init__(self, manifest, include_price=False, fields=None, incremental=False,
+                 resume=False):
+        self.manifest = manifest
+        self.include_price = include_price
+        self.fields = fields
+        self.incremental = incremental
+        self.resume = resume
+
+        self.handler = Handler()
+        self.handler.create_all()
+
+        self.books_info = {}
+        self.listing_books = {}
+        self.book_records = {}
+
+    @staticmethod
+    def read_manifest(file_path):
+        """Read list of {"profile_name": ..., "shelf_name": ...} entries."""
+        with open(file_path, 'r', encoding='utf-8') as file_handle:
+            manifest = json.load(file_handle)
+
+        if not (isinstance(manifest, list)
+                and all(isinstance(entry, dict)
+                        and entry.get('profile_name') and entry.get('shelf_name')
+                        for entry in manifest)):
+            raise ValueError('Manifest must be a list of profile_name and shelf_name entries')
+
+        return manifest
+
+    def run(self):
+        scrapers = [self.make_scraper(entry) for entry in self.manifest]
+        if not scrapers:
+            return
+
+        with ShelfScraper.make_session() as session,\
+                LatencyPolicy() as latency,\
+                Pool(processes=cpu_count()) as pages_pool,\
+                Pool(processes=(cpu_count() * 2)) as pool:
+            # Stale books are refreshed with the session of the first scraper.
+            scrapers[0].session = session
+            scrapers[0].latency = latency
+            with ParsingExecutor(scrapers[0].parsing_mode,
+                                 scrapers[0].parsing_workers) as parser,\
+                    BooksRevalidator(scrapers[0]) as revalidator:
+                scrapers[0].parser = parser
+                for scraper in scrapers:
+                    self.logger.info(f'Scraping shelf "{scraper.shelf_name}"'
+                                     f' of profile "{scraper.profile_name}"')
+                    scraper.session = session
+                    scraper.latency = latency
+                    scraper.pages_pool = pages_pool
+                    scraper.pool = pool
+                    scraper.revalidator = revalidator
+                    scraper.parser = parser
+                    scraper.scrape()
+        latency.log_metrics(self.logger)
+
+    def make_scraper(self, entry):
+        scraper = self.scraper_class(profile_name=entry['profile_name'],
+                                     shelf_name=entry['shelf_name'],
+                                     include_price=self.include_price,
+                                     fields=self.fields,
+                                     incremental=self.incremental,
+                                     resume=self.resume,
+                                     handler=self.handler)
+        # Books collected for previous profiles are reused.
+        scraper.books_info = self.books_info
+        scraper.listing_books = self.listing_books
+        scraper.book_records = self.book_records
+        return scraper
+
+
+class AsyncShelfScraper(ShelfScraper):
+    """Shelf scraper running all requests on a single asyncio event loop.
+
+    Number of concurrent requests to a single host is limited by a semaphore
+    sized with the `host_concurrency` config option. Book pages are fetched by
+    `host_concurrency` workers from a queue bounded by `books_queue_size`.
+    Failed pages and books are retried with backoff like in threads engine,
+    incremental sync and resumed runs are not supported.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.host_concurrency = self.config.getint('host_concurrency', fallback=8)
+        self.host_semaphores = {}
+        self.loop = None
+        self.revalidate_semaphore = None
+        self.revalidate_tasks = {}
+
+    def run(self):
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.revalidate_semaphore = asyncio.Semaphore(self.revalidate_concurrency)
+        connector = aiohttp.TCPConnector(limit_per_host=self.host_concurrency)
+        with ParsingExecutor(self.parsing_mode, self.parsing_workers) as self.parser:
+            async with aiohttp.ClientSession(connector=connector) as self.session:
+                try:
+                    await self.scrape_async()
+                finally:
+                    await self.finish_revalidation()
+        self.latency.log_metrics(self.logger)
+
+    async def scrape_async(self):
+        # Fetch profile id for given name
+        try:
+            self.profile_id = await self.get_profile_id()
+        except ProfileNotFoundError as e:
+            self.logger.error(f'Profile search failed: {e}')
+            return
+
+        try:
+            self.shelves = await self.get_book_shelves()
+        except ShelvesScrapeError as e:
+            self.logger.error(f'Shelf "{self.shelf_name}" not found: {e}')
+            return
+
+        # Fetch books from given shelves.
+        try:
+            await self.get_books()
+        except (BooksCollectError, DatabaseError) as e:
+            self.logger.error(e)
+            return
+
+    def get_host_semaphore(self, url):
+        host = urlparse(url).netloc
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(self.host_concurrency)
+        return self.host_semaphores[host]
+
+    async def fetch(self, method, url, **kwargs):
+        async with self.get_host_semaphore(url):
+            return await self.latency.fetch(self.session, method, url,
+                                            raise_for_status=True, **kwargs)
+
+    async def run_in_executor(self, func, *args):
+        # Database access is blocking, keep it off the event loop.
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def get_profile_id(self):
+        profile_id = self.match_profile_by_name(await self.search_for_profile())
+        await self.run_in_executor(self.store_profile_id, profile_id)
+        return profile_id
+
+    async def search_for_profile(self):
+        self.logger.info(f'Searching for profile "{self.profile_name}"')
+        try:
+            # Query user.
+            content = await self.fetch(
+                'POST',
+                self.config['lc_profile_search_url'],
+                data={'phrase': self.profile_name},
+                headers={'X-Requested-With': 'XMLHttpRequest'},
+            )
+
+            # Parse json response.
+            search_results = self.parse_profile_search(json.loads(content))
+        except (aiohttp.ClientError, asyncio.TimeoutError, JSONDecodeError, KeyError) as e:
+            raise ProfileNotFoundError(f'HTML request error: {e}')
+
+        return search_results
+
+    async def get_book_shelves(self):
+        return await self.build_book_shelves_from_shelf_tags(
+            await self.search_for_book_shelf_tags()
+        )
+
+    async def search_for_book_shelf_tags(self):
+        self.logger.info(f'Searching for shelf "{self.shelf_name}"'
+                         if self.shelf_name != 'all'
+                         else 'Fetching all book shelves')
+        try:
+            content = await self.fetch('GET', self.get_profile_library_url())
+            shelf_tags = self.parse_shelf_tags(content)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise ShelvesScrapeError(f'HTML request error: {e}')
+
+        if not shelf_tags:
+            raise ShelvesScrapeError('Shelves list not found')
+
+        return shelf_tags
+
+    async def build_book_shelves_from_shelf_tags(self, shelf_tags):
+        book_shelves = await asyncio.gather(*[
+            self.get_book_shelf(shelf_tag) for shelf_tag in shelf_tags
+        ])
+
+        self.logger.info(f'Found shelf matching "{self.shelf_name}"'
+                         if self.shelf_name != 'all'
+                         else 'Fetched all book shelves')
+
+        return list(book_shelves)
+
+    async def get_book_shelf(self, shelf_tag):
+        shelf_id = shelf_tag['value']
+        shelf_name = shelf_tag['data-shelf-name']
+        shelf_url = self.get_shelf_url(shelf_id)
+
+        try:
+            self.logger.debug(f'Fetching "{shelf_name}" shelf page at {shelf_url}')
+            content = await self.fetch('GET', shelf_url)
+            self.logger.debug(f'Fetching "{shelf_name}" pager info')
+            pager_count = self.parse_pager_count(content)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise ShelvesScrapeError(f'HTML request error: {e}')
+
+        return self.make_shelf(shelf_id, shelf_name, pager_count)
+
+    async def get_books(self):
+        shelves_book_urls = []
+        for shelf in self.shelves:
+            self.logger.debug(f'Fetching "{shelf["name"]}" shelf books')
+            shelf_book_urls = await self.get_shelf_book_urls(shelf)
+            shelves_book_urls.append((shelf, shelf_book_urls))
+
+            if not shelf_book_urls:
+                self.logger.warning(f'No books found on shelf {shelf["name"]}')
+                continue
+            self.logger.debug(f'Shelf book urls: {shelf_book_urls}')
+
+            shelf_books = await self.get_books_from_urls(shelf_book_urls)
+            self.logger.debug(f'Shelf books: {shelf_books}')
+
+            if self.include_price:
+                await self.set_book_prices(shelf_books)
+
+            self.sort_books_list(shelf_books)
+            self.save_books_list(shelf['name'], shelf_books)
+            await self.run_in_executor(self.store_shelf_isbn_index, shelf['name'], shelf_books)
+
+        await self.run_in_executor(self.store_shelf_snapshots, shelves_book_urls)
+
+    async def get_shelf_book_urls(self, shelf):
+        pages_info = [json.dumps({'page': page, 'shelf_id': shelf['id']})
+                      for page in range(1, shelf['pager_count'] + 1)]
+
+        shelf_book_urls = [
+            book_url
+            for book_urls in await asyncio.gather(*[
+                self.retry_async(self.get_page_book_urls, page_info) for page_info in pages_info
+            ])
+            for book_url in book_urls
+        ]
+        return shelf_book_urls
+
+    async def get_page_book_urls(self, page_info_json):
+        try:
+            page_info = json.loads(page_info_json)
+            data = self.get_page_request_data(page_info)
+            self.logger.debug(f'Requesting page {self.config["lc_shelf_page_url"]}'
+                              f' with data {data}')
+            content = await self.fetch(
+                'POST',
+                self.config['lc_shelf_page_url'],
+                data=data,
+                headers={'X-Requested-With': 'XMLHttpRequest'},
+            )
+
+            # Parse json response, HTML part is parsed off the event loop.
+            listing_books = await self.parser.run_async(parse_listing_page,
+                                                        json.loads(content)['data']['content'],
+                                                        self.config['lc_url'])
+            book_urls = self.store_listing_books(self.check_page_books(listing_books, page_info))
+        except JSONDecodeError as e:
+            raise BooksCollectError(f'JSON error: {e}')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise BooksCollectError(f'HTML request error: {e}')
+
+        return book_urls
+
+    async def get_books_from_urls(self, shelf_book_urls):
+        if self.fetch_book_details:
+            await self.get_books_info(shelf_book_urls)
+
+        return [self.get_book_record(book_url) for book_url in shelf_book_urls]
+
+    async def get_books_info(self, shelf_book_urls):
+        # Books collected from previous shelves are reused.
+        books_info = {book_url: self.books_info[book_url]
+                      for book_url in shelf_book_urls if book_url in self.books_info}
+
+        # Resolve cached books for whole shelf at once, fetch only the misses.
+        books_info.update(await self.run_in_executor(self.get_books_info_from_db, [
+            book_url for book_url in shelf_book_urls if book_url not in books_info
+        ]))
+        self.books_info.update(books_info)
+        missing_urls = [book_url for book_url in dict.fromkeys(shelf_book_urls)
+                        if book_url not in books_info]
+        self.logger.debug(f'Got {len(books_info)} cached books,'
+                          f' fetching {len(missing_urls)} books')
+
+        book_urls_queue = asyncio.Queue(maxsize=self.books_queue_size)
+        fetched_books = []
+        tasks = [asyncio.ensure_future(self.put_book_urls(book_urls_queue, missing_urls))]
+        tasks.extend(asyncio.ensure_future(self.collect_books_info(book_urls_queue, books_info,
+                                                                   fetched_books))
+                     for _ in range(self.host_concurrency))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # Stop remaining workers when one of them failed.
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.run_in_executor(self.store_books_info, fetched_books)
+
+    async def put_book_urls(self, book_urls_queue, book_urls):
+        for book_url in book_urls:
+            await book_urls_queue.put(book_url)
+        for _ in range(self.host_concurrency):
+            await book_urls_queue.put(None)
+
+    async def collect_books_info(self, book_urls_queue, books_info, fetched_books):
+        while True:
+            book_url = await book_urls_queue.get()
+            if book_url is None:
+                return
+
+            book_info = await self.retry_async(self.get_book_info_by_url, book_url)
+            books_info[book_info['url']] = book_info
+            self.books_info[book_info['url']] = book_info
+            fetched_books.append(book_info)
+            # Write fresh results back in batches.
+            if len(fetched_books) >= self.cache_batch_size:
+                batch = fetched_books[:]
+                fetched_books.clear()
+                await self.run_in_executor(self.store_books_info, batch)
+
+    async def get_book_info(self, book_url):
+        # Check if current book info exists in DB.
+        books_info = await self.run_in_executor(self.get_books_info_from_db, [book_url])
+        if books_info.get(book_url):
+            return books_info[book_url]
+
+        book_info = await self.get_book_info_by_url(book_url)
+        await self.run_in_executor(self.store_books_info, [book_info])
+
+        return book_info
+
+    async def get_book_info_by_url(self, book_url):
+        try:
+            if self.incremental_parsing:
+                extractor = await self.fetch('GET', book_url,
+                                             read=BookPageExtractor.read_async)
+                book_info = (extractor.get_book_info(book_url) if extractor.done
+                             else await self.parser.run_async(parse_book_page, book_url,
+                                                              extractor.content))
+            else:
+                content = await self.fetch('GET', book_url)
+                book_info = await self.parser.run_async(parse_book_page, book_url, content)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise BooksCollectError(f'HTML request error: {e}')
+
+        return book_info
+
+    def revalidate_books_info(self, book_urls):
+        # Called from executor threads, schedule refresh on the event loop.
+        self.loop.call_soon_threadsafe(self.schedule_revalidation, book_urls)
+
+    def schedule_revalidation(self, book_urls):
+        for book_url in book_urls:
+            if book_url not in self.revalidate_tasks:
+                self.revalidate_tasks[book_url] = asyncio.ensure_future(
+                    self.revalidate_book_info(book_url)
+                )
+
+    async def retry_async(self, func, *args):
+        return await retry_call_async(func, *args, exceptions=(BooksCollectError,),
+                                      attempts=self.retry_attempts, backoff=self.retry_backoff)
+
+    async def revalidate_book_info(self, book_url):
+        try:
+            async with self.revalidate_semaphore:
+                # Skip progress reporting of subclasses, refresh runs in background.
+                return await AsyncShelfScraper.get_book_info_by_url(self, book_url)
+        except BooksCollectError as e:
+            self.logger.warning(f'Refreshing stale book {book_url} failed: {e}')
+            return None
+
+    async def finish_revalidation(self):
+        if not self.revalidate_tasks:
+            return
+
+        done, pending = await asyncio.wait(self.revalidate_tasks.values(),
+                                           timeout=self.revalidate_timeout)
+        if pending:
+            # Dropped books stay stale and are picked up by the next run.
+            self.logger.debug('Refreshing stale books exceeded time budget')
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        fetched_books = [book_info for book_info in (task.result() for task in done)
+                         if book_info is not None]
+        try:
+            for books_chunk in chunked(fetched_books, self.cache_batch_size):
+                await self.run_in_executor(self.store_books_info, books_chunk)
+        except DatabaseError as e:
+            self.logger.error(f'Storing refreshed books failed: {e}')
+
+        self.logger.info(f'Refreshed {len(fetched_books)} of'
+                         f' {len(self.revalidate_tasks)} stale books')
+
+    async def set_book_prices(self, shelf_books):
+        await self.price_scraper_class(handler=self.handler).update_book_prices(shelf_books)
+
+
 class CLIShelfScraper(ShelfScraper):
     logger = logging.getLogger('script')
+    price_scraper_class = CLIPriceScraper
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.bar = None
         self.lock = Lock()
 
-    def get_shelf_book_urls(self, shelf):
-        bar_title = f'Collecting shelf pages'
-        with ProgressBar(bar_title, max=shelf["pager_count"]) as self.bar:
-            shelf_book_urls = super().get_shelf_book_urls(shelf)
-        return shelf_book_urls
+    def get_shelves_books(self, shelves):
+        # Bar starts with shelf pages and grows with every book found on them.
+        bar_title = 'Collecting shelf books'
+        bar_max = sum(shelf['pager_count'] for shelf in shelves)
+        with ProgressBar(bar_title, max=bar_max) as self.bar:
+            shelves_books = super().get_shelves_books(shelves)
+        return shelves_books
 
     def get_page_book_urls(self, page_info_json):
         book_urls = super().get_page_book_urls(page_info_json)
@@ -439,30 +1518,77 @@ class CLIShelfScraper(ShelfScraper):
             self.bar.next()
         return book_urls
 
-    def get_books_from_urls(self, shelf_book_urls):
-        bar_title = 'Collecting books'
-        with ProgressBar(bar_title, max=len(shelf_book_urls)) as self.bar:
-            shelf_books = super().get_books_from_urls(shelf_book_urls)
-        return shelf_books
+    def sync_shelf_book_urls(self, shelf):
+        book_urls = super().sync_shelf_book_urls(shelf)
+        # Shelf pages below the synced ones were not fetched.
+        with self.lock:
+            self.bar.max += shelf['synced_pages'] - shelf['pager_count']
+            self.bar.update()
+        return book_urls
 
-    def get_book_info(self, book_url):
-        book_info = super().get_book_info(book_url)
+    def get_journal_pages(self, shelf_ids):
+        journal_pages = super().get_journal_pages(shelf_ids)
+        # Journaled pages are not fetched again.
         with self.lock:
-            self.bar.next()
-        return book_info
+            self.bar.next(len(journal_pages))
+        return journal_pages
 
-    def set_book_prices(self, shelf_books):
-        bar_title = 'Collecting book prices'
-        with ProgressBar(bar_title, max=len(shelf_books)) as self.bar:
-            super().set_book_prices(shelf_books)
+    def get_books_info_from_db(self, book_urls):
+        books_info = super().get_books_info_from_db(book_urls)
+        # Bar grows with books that are looked up.
+        with self.lock:
+            self.bar.max += len(set(book_urls))
+            self.bar.next(len(books_info))
+        return books_info
 
-    def set_book_price(self, book):
-        super().set_book_price(book)
+    def get_book_info_by_url(self, book_url):
+        book_info = super().get_book_info_by_url(book_url)
         with self.lock:
             self.bar.next()
+        return book_info
 
     def save_books_list(self, shelf_name, shelf_books):
         self.logger.info(f'Writing books on shelf {shelf_name} to file')
         file_path = shelf_name_to_file_path(self.profile_name, shelf_name)
         with open(file_path, 'w', encoding='utf-8') as file_handle:
             json.dump(shelf_books, file_handle, ensure_ascii=False, indent=2)
+
+
+class CLIAsyncShelfScraper(AsyncShelfScraper, CLIShelfScraper):
+    logger = logging.getLogger('script')
+
+    async def get_shelf_book_urls(self, shelf):
+        bar_title = 'Collecting shelf pages'
+        with ProgressBar(bar_title, max=shelf["pager_count"]) as self.bar:
+            shelf_book_urls = await super().get_shelf_book_urls(shelf)
+        return shelf_book_urls
+
+    async def get_page_book_urls(self, page_info_json):
+        book_urls = await super().get_page_book_urls(page_info_json)
+        self.bar.next()
+        return book_urls
+
+    async def get_books_from_urls(self, shelf_book_urls):
+        bar_title = 'Collecting books'
+        with ProgressBar(bar_title, max=len(set(shelf_book_urls))) as self.bar:
+            shelf_books = await super().get_books_from_urls(shelf_book_urls)
+            # Books built from listing page only.
+            self.bar.goto(self.bar.max)
+        return shelf_books
+
+    async def get_book_info_by_url(self, book_url):
+        book_info = await super().get_book_info_by_url(book_url)
+        self.bar.next()
+        return book_info
+
+    def get_books_info_from_db(self, book_urls):
+        # Bar size is known upfront, skip growing it.
+        books_info = ShelfScraper.get_books_info_from_db(self, book_urls)
+        with self.lock:
+            self.bar.next(len(books_info))
+        return books_info
+
+
+class CLIShelfScraperBatch(ShelfScraperBatch):
+    logger = logging.getLogger('script')
+    scraper_class = CLIShelfScraper
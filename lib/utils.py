@@ -1,6 +1,9 @@
 import re
 import os
-from contextlib import contextmanager
+import time
+import asyncio
+import logging
+from contextlib import contextmanager, suppress
 from bs4 import BeautifulSoup
 from progress.bar import Bar
 from progress.counter import Counter
@@ -17,6 +20,61 @@ def bs4_scope(markup):
         parsed_markup.decompose()
 
 
+def chunked(items, size):
+    '''Split list of items into consecutive lists of given size.'''
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def retry_call(func, *args, exceptions, attempts=3, backoff=1.0):
+    '''Call function, retrying on given exceptions with exponential backoff.'''
+    for attempt in range(1, attempts + 1):
+        try:
+            return func(*args)
+        except exceptions as e:
+            if attempt == attempts:
+                raise
+            delay = backoff * 2 ** (attempt - 1)
+            logging.getLogger(__name__).debug(f'Retrying {func.__name__} in {delay}s: {e}')
+            time.sleep(delay)
+
+
+async def retry_call_async(func, *args, exceptions, attempts=3, backoff=1.0):
+    '''Await coroutine function, retrying on given exceptions with exponential backoff.'''
+    for attempt in range(1, attempts + 1):
+        try:
+            return await func(*args)
+        except exceptions as e:
+            if attempt == attempts:
+                raise
+            delay = backoff * 2 ** (attempt - 1)
+            logging.getLogger(__name__).debug(f'Retrying {func.__name__} in {delay}s: {e}')
+            await asyncio.sleep(delay)
+
+
+def normalize_isbn(isbn):
+    '''Return ISBN-13 form of valid ISBN-10 or ISBN-13, None for invalid ISBN.'''
+    isbn = re.sub(r'[^\dX]+', '', (isbn or '').upper())
+
+    if len(isbn) == 10 and isbn[:9].isdigit():
+        checksum = sum((10 - position) * (10 if digit == 'X' else int(digit))
+                       for position, digit in enumerate(isbn))
+        if checksum % 11:
+            return None
+        isbn = f'978{isbn[:9]}'
+        return f'{isbn}{isbn13_check_digit(isbn)}'
+
+    if len(isbn) == 13 and isbn.isdigit():
+        return isbn if isbn[-1] == isbn13_check_digit(isbn[:12]) else None
+
+    return None
+
+
+def isbn13_check_digit(isbn):
+    checksum = sum(int(digit) * (3 if position % 2 else 1)
+                   for position, digit in enumerate(isbn[:12]))
+    return str((10 - checksum % 10) % 10)
+
+
 def get_file_path(*file_name):
     return os.path.join(os.getcwd(), *file_name)
 
@@ -27,6 +85,52 @@ def shelf_name_to_file_path(profile_name, shelf_name):
     return get_file_path('var', file_name)
 
 
+class EventLoopMonitor:
+    '''Measure event loop lag as delay of periodic wake ups.
+
+    Only running aggregates are kept, memory use doesn't grow with run time.
+    '''
+
+    def __init__(self, interval=0.01, stall_threshold=0.05):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.samples = 0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.stalls = 0
+        self.task = None
+
+    async def __aenter__(self):
+        self.task = asyncio.ensure_future(self.measure())
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self.task
+
+    async def measure(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.record(loop.time() - start - self.interval)
+
+    def record(self, lag):
+        self.samples += 1
+        self.max_lag = max(self.max_lag, lag)
+        self.total_lag += lag
+        self.stalls += lag >= self.stall_threshold
+
+    def __str__(self):
+        if not self.samples:
+            return 'no samples'
+
+        return (f'max {self.max_lag * 1000:.0f}ms,'
+                f' mean {self.total_lag / self.samples * 1000:.1f}ms,'
+                f' {self.stalls} stalls over {self.stall_threshold * 1000:.0f}ms')
+
+
 class ProgressBar(Bar):
     check_tty = False
 
@@ -0,0 +1,21 @@
+import click
+import logging.config
+from lib.catalog_mirror import CLICatalogMirror
+from lib.utils import get_file_path
+
+logging.config.fileConfig(get_file_path('etc', 'config.ini'))
+
+
+@click.command()
+@click.pass_context
+@click.option('--library-id',
+              type=click.Choice(list(CLICatalogMirror.news_libraries), case_sensitive=False),
+              help='Library id (required)')
+@click.option('--full', is_flag=True, default=False,
+              help='Refetch all documents instead of new and stale ones')
+def run(context, library_id, full):
+    if not library_id:
+        click.echo(context.get_help(), color=context.color)
+        return
+
+    CLICatalogMirror(library_id=library_id, full=full).run()
@@ -11,27 +11,37 @@ from lib.config import Config
 
 logging.config.fileConfig(get_file_path('etc', 'config.ini'))
 
+# Only libraries with news feed crawler can be selected.
+LIBRARY_IDS = [library_id for library_id in Config()['latest_books_scraper'].getstruct('libraries')
+               if library_id in CLILatestBooksScraper.libraries]
+
 
 @click.command()
 @click.pass_context
-@click.option('--library-id',
-              type=click.Choice(Config()['latest_books_scraper'].getstruct('libraries'),
-                                case_sensitive=False),
-              help='Library id (required)')
+@click.option('--library-id', 'library_ids', multiple=True,
+              type=click.Choice([*LIBRARY_IDS, 'all'], case_sensitive=False),
+              help='Library id, may be repeated; "all" selects every configured'
+                   ' library (required)')
 @click.option('--profile-name', help='Profile name (required)')
 @click.option('--auth-data', help='Path to Google auth credentials')
 @click.option('--refresh', is_flag=True, default=False, help="Refresh shelf books info")
-def run(context, library_id, profile_name, auth_data, refresh):
-    if not(library_id and profile_name):
+@click.option('--full', is_flag=True, default=False,
+              help='Crawl whole news feed instead of books added since last run')
+def run(context, library_ids, profile_name, auth_data, refresh, full):
+    if not(library_ids and profile_name):
         click.echo(context.get_help(), color=context.color)
         return
 
+    if 'all' in library_ids:
+        library_ids = LIBRARY_IDS
+
     try:
         latest_books_scraper = CLILatestBooksScraper(
-            library_id=library_id,
+            library_ids=library_ids,
             profile_name=profile_name,
             auth_data=auth_data,
-            refresh=refresh
+            refresh=refresh,
+            full=full,
         )
         latest_books_scraper.run()
     except (LibraryNotSupported, LibraryPageNotValid,
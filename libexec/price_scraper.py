@@ -0,0 +1,29 @@
+import click
+import logging.config
+from lib.price_scraper import CLIPriceScraper
+from lib.exceptions import BooksListUnavailable
+from lib.utils import get_file_path
+
+logging.config.fileConfig(get_file_path('etc', 'config.ini'))
+
+
+@click.group()
+def run():
+    pass
+
+
+@run.command()
+@click.pass_context
+@click.option('--profile-name', help='Profile name (required)')
+@click.option('--shelf-name', help='Shelf name to refresh, "all" for all stored shelves (required)')
+@click.option('--force', is_flag=True, default=False, help='Ignore cached prices')
+def refresh(context, profile_name, shelf_name, force):
+    if not(profile_name and shelf_name):
+        click.echo(context.get_help(), color=context.color)
+        return
+
+    try:
+        CLIPriceScraper(force=force).refresh(profile_name=profile_name,
+                                             shelf_name=shelf_name)
+    except BooksListUnavailable as e:
+        click.echo(e, color=context.color)
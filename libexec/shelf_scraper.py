@@ -1,23 +1,75 @@
 import click
 import logging.config
-from lib.shelf_scraper import CLIShelfScraper
+from lib.shelf_scraper import (ShelfScraper, CLIShelfScraper, CLIAsyncShelfScraper,
+                               CLIShelfScraperBatch)
 from lib.utils import get_file_path
 
 logging.config.fileConfig(get_file_path('etc', 'config.ini'))
 
 
+def parse_fields(context, param, value):
+    if not value:
+        return None
+
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    unknown_fields = set(fields).difference(ShelfScraper.book_fields)
+    if unknown_fields:
+        raise click.BadParameter(f'Unknown fields: {", ".join(sorted(unknown_fields))}')
+    return fields
+
+
+def read_manifest(context, param, value):
+    if not value:
+        return None
+
+    try:
+        return CLIShelfScraperBatch.read_manifest(value)
+    except (OSError, ValueError) as e:
+        raise click.BadParameter(f'Could not read manifest: {e}')
+
+
 @click.command()
 @click.pass_context
 @click.option('--profile-name', help='Profile name (required)')
 @click.option('--shelf-name', help='Shelf name to search (required)')
 @click.option('--include-price', is_flag=True, default=False,
               help='Append price to books')
-def run(context, profile_name, shelf_name, include_price):
+@click.option('--engine', type=click.Choice(['threads', 'async']), default='threads',
+              help='Concurrency engine used for fetching pages. Async engine doesn\'t'
+                   ' support --incremental, --manifest and --resume')
+@click.option('--fields', callback=parse_fields,
+              help='Comma separated book fields to collect. Book page is skipped'
+                   ' when all fields are available on shelf page (title, author)')
+@click.option('--incremental', is_flag=True, default=False,
+              help='Sync shelves against snapshots from previous runs')
+@click.option('--manifest', callback=read_manifest,
+              help='Path to JSON list of profile_name and shelf_name pairs to scrape'
+                   ' in one run (replaces --profile-name and --shelf-name)')
+@click.option('--resume', is_flag=True, default=False,
+              help='Continue from shelf pages collected by a failed previous run')
+def run(context, profile_name, shelf_name, include_price, engine, fields, incremental,
+        manifest, resume):
     # Display help message when no arguments given.
-    if not(profile_name and shelf_name):
+    if not((profile_name and shelf_name) or manifest):
         click.echo(context.get_help(), color=context.color)
         return
 
-    CLIShelfScraper(profile_name=profile_name,
-                    shelf_name=shelf_name,
-                    include_price=include_price).run()
+    if (incremental or manifest or resume) and engine == 'async':
+        raise click.BadOptionUsage('engine', 'Incremental sync, manifest and resumed runs'
+                                             ' require threads engine')
+
+    if manifest:
+        CLIShelfScraperBatch(manifest=manifest,
+                             include_price=include_price,
+                             fields=fields,
+                             incremental=incremental,
+                             resume=resume).run()
+        return
+
+    shelf_scraper = CLIAsyncShelfScraper if engine == 'async' else CLIShelfScraper
+    shelf_scraper(profile_name=profile_name,
+                  shelf_name=shelf_name,
+                  include_price=include_price,
+                  fields=fields,
+                  incremental=incremental,
+                  resume=resume).run()
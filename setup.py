@@ -13,6 +13,8 @@ setup(
             'shelf_scraper=libexec.shelf_scraper:run',
             'library_scraper=libexec.library_scraper:run',
             'latest_books_scraper=libexec.latest_books_scraper:run',
+            'price_scraper=libexec.price_scraper:run',
+            'catalog_mirror=libexec.catalog_mirror:run',
         ],
     },
 )